@@ -0,0 +1,574 @@
+""" Benchmarks for the intermix annotation hot path
+
+Run with `python benchmarks.py`, which prints the results of each benchmark. The results can be saved as a baseline
+with `--save baseline.json`, and later runs compared against it with `--compare baseline.json`, which fails if any
+of the CHECKED_METRICS regressed by more than `--threshold`. Use `--only` to run some of the benchmarks.
+
+Timings are the median of REPEATS repeats, each relative to a reference loop timed right after it, and are given in
+microseconds at the fastest speed the reference loop ran at. A comparison scales the baseline timings by the
+reference loop times of the two runs, so a busy or different machine doesn't show up as a regression. Every
+benchmark runs with empty caches and has the hooks, operators and settings it changes restored afterwards, so it
+measures the same on its own as in a full run.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+from contextlib import contextmanager
+import gc
+import inspect
+import json
+from mock import patch
+import os
+import psycopg2
+import re
+import subprocess
+import sys
+import timeit
+
+import intermix
+
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.operators.postgres_operator import PostgresOperator
+
+
+# A call site like the ones annotated inside a deployed DAG
+INSPECTED = ('/usr/local/airflow/dags/warehouse/load_daily_events.py', 'warehouse.load_daily_events',
+             'LoadDailyEvents', 'load_partition', '214')
+
+
+def bench_annotation_size():
+    """ Compares the annotation size of each encoding version, for hook and operator annotations """
+
+    operator = PostgresOperator(sql='select 1;', task_id='load_daily_events', pool='redshift')
+    results = []
+    for name, _self in (('hook', None), ('operator', operator)):
+        sizes = {}
+        for version in (1, 2):
+            with patch.object(intermix, 'ANNOTATION_VERSION', version):
+                sizes[version] = len(intermix.annotator(INSPECTED, _self))
+        results.append({'benchmark': 'annotation_size', 'case': name, 'v1_bytes': sizes[1], 'v2_bytes': sizes[2],
+                        'reduction': round(1 - float(sizes[2]) / sizes[1], 3)})
+    return results
+
+
+# Statement sizes from 1 KB up to 4,000,000 characters, the most that always fit Redshift's 16MB limit
+STATEMENT_SIZES = (1000, 10000, 100000, 1000000, 4000000)
+
+
+# Timings are the median of this many repeats, which is steadier than the best one on a busy machine
+REPEATS = 7
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+# Copied and scanned by the reference loop, a statement too long to stay in the CPU caches
+_REFERENCE_TEXT = "insert into events values (1, 'event');" * 25000
+
+
+def _reference_loop():
+    """ A fixed amount of work like that of the hot path, which the other timings are calibrated against: formatting
+    and calling Python functions, and copying and scanning a long statement
+    """
+
+    total = 0
+    for index in range(500):
+        total += len('{}:{}'.format(index, total))
+    return total + len(_REFERENCE_TEXT + ' ') + _REFERENCE_TEXT.count(';')
+
+
+def _reference_us():
+    """ Times the reference loop, in microseconds """
+
+    return timeit.timeit(_reference_loop, number=5) / 5 * 1e6
+
+
+_calibration = []
+
+
+def _calibration_us():
+    """ The fastest time of the reference loop, in microseconds, measured once per run """
+
+    if not _calibration:
+        _calibration.append(round(min(_reference_us() for _ in range(50)), 2))
+    return _calibration[0]
+
+
+def _calibrated(measure, repeat=REPEATS):
+    """ Calls `measure`, which returns a time in microseconds, `repeat` times and returns the median of those times
+    relative to the reference loop timed right after each of them, in microseconds at the speed of _calibration_us().
+    The speed of a busy machine changes from one second to the next, which changes both times alike.
+    """
+
+    ratios = []
+    for _ in range(repeat):
+        elapsed = measure()
+        ratios.append(elapsed / _reference_us())
+    return round(_median(ratios) * _calibration_us(), 2)
+
+
+# Repeats time enough calls to take at least this long, as the time of fewer calls is mostly that of page faults and
+#   other interruptions
+MIN_REPEAT_SECONDS = 0.01
+
+
+def _time_us(func, number=None, repeat=REPEATS):
+    """ Returns the calibrated per-call time of `func` in microseconds, see _calibrated(), over `number` calls per
+    repeat. By default, the number of calls is doubled until they take MIN_REPEAT_SECONDS.
+    """
+
+    timer = timeit.Timer(func)
+    if number is None:
+        number = 1
+        while timer.timeit(number) < MIN_REPEAT_SECONDS:
+            number *= 2
+    return _calibrated(lambda: timer.timeit(number) / number * 1e6, repeat)
+
+
+def _statement(size):
+    """ Builds an INSERT statement of about `size` characters """
+
+    row = "(1, 'event', '2018-01-01 00:00:00'),"
+    return 'insert into events values {};'.format(row * (size // len(row)))
+
+
+def bench_prior_annotation_detection():
+    """ Compares full-text and head-anchored detection of a prior annotation, with and without one present """
+
+    blob = intermix.annotator(INSPECTED)
+    results = []
+    for size in STATEMENT_SIZES:
+        sql = _statement(size)
+        annotated = blob + sql
+        for case, statement in (('unannotated', sql), ('annotated', annotated)):
+            results.append({
+                'benchmark': 'prior_annotation_detection', 'case': case, 'size': size,
+                'search_us': _time_us(lambda: re.search(intermix.INTERMIX_RE, statement)),
+                'in_us': _time_us(lambda: '/* INTERMIX_ID:' not in statement),
+                'anchored_us': _time_us(lambda: intermix.match_annotation(statement)),
+                'strip_and_prepend_us': _time_us(
+                    lambda: '{}{}'.format(blob, re.sub(intermix.INTERMIX_RE, '', statement))),
+                'replace_us': _time_us(
+                    lambda: statement.replace(intermix.match_annotation(statement).groups()[0], blob, 1)
+                    if statement is annotated else '{}{}'.format(blob, statement))})
+    return results
+
+
+def bench_fingerprint():
+    """ Measures fingerprint() from 1 KB to 4,000,000 character statements, for new statements and for a statement
+    that is resent, and the overhead it adds to annotator()
+    """
+
+    results = []
+    for size in STATEMENT_SIZES:
+        # About 1 MB of statements per repeat, which can't be timed over more calls than there are statements
+        number = max(1, 1000000 // size)
+        sql = _statement(size)
+        # Separately built statements, so none of them is memoized
+        statements = [_statement(size) for _ in range(number * REPEATS)]
+        copies = iter(statements)
+        results.append({'benchmark': 'fingerprint', 'case': 'new', 'size': size,
+                        'per_call_us': _time_us(lambda: intermix.fingerprint(next(copies)), number)})
+        results.append({'benchmark': 'fingerprint', 'case': 'resent', 'size': size,
+                        'per_call_us': _time_us(lambda: intermix.fingerprint(sql))})
+        with patch.object(intermix, 'FINGERPRINT_STATEMENTS', True):
+            copies = iter([_statement(size) for _ in range(number * REPEATS)])
+            results.append({'benchmark': 'fingerprint', 'case': 'annotator', 'size': size,
+                            'per_call_us': _time_us(lambda: intermix.annotator(INSPECTED, statement=next(copies)),
+                                                    number)})
+    return results
+
+
+def _script(size):
+    """ Builds a script of about `size` characters of short statements with strings, comments and dollar quotes """
+
+    statements = ("insert into events values (1, 'a;b', 'c''d');\n", '-- reload; the next statement\n',
+                  'select $$ ; $$ /* ; */ from events;\n')
+    chunk = ''.join(statements)
+    return chunk * max(1, size // len(chunk))
+
+
+def bench_split_statements():
+    """ Measures split_statements() over 1 KB to 4,000,000 character scripts, which should grow linearly """
+
+    results = []
+    for size in STATEMENT_SIZES:
+        script = _script(size)
+        results.append({'benchmark': 'split_statements', 'case': 'script', 'size': size,
+                        'per_call_us': _time_us(lambda: intermix.split_statements(script))})
+    return results
+
+
+class StubCursor(object):
+    """ A cursor over a result of `row_count` rows, which are only built as they are fetched """
+
+    def __init__(self, row_count):
+        self.row_count = row_count
+        self.position = 0
+
+    def execute(self, sql, parameters=None):
+        self.position = 0
+
+    def _rows(self, count):
+        count = min(count, self.row_count - self.position)
+        rows = [(self.position + index, 'event', '2018-01-01 00:00:00') for index in range(count)]
+        self.position += count
+        return rows
+
+    def fetchmany(self, size):
+        return self._rows(size)
+
+    def fetchall(self):
+        return self._rows(self.row_count)
+
+    def close(self):
+        pass
+
+
+class StubConnection(object):
+
+    def __init__(self, row_count):
+        self.row_count = row_count
+
+    def cursor(self, name=None):
+        return StubCursor(self.row_count)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _peak_memory(func):
+    """ Returns the peak memory allocated while running `func`, in KB """
+
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def bench_streaming_memory():
+    """ Compares the peak memory of consuming a result with get_records and with iter_records. It is skipped before
+    Python 3.4, which has no tracemalloc.
+    """
+
+    if sys.version_info < (3, 4):
+        return []
+
+    hook = PostgresHook(postgres_conn_id='postgres_default')
+
+    def consume(records):
+        for record in records:
+            pass
+
+    results = []
+    for row_count in (10000, 100000, 1000000):
+        with patch.object(psycopg2, 'connect', lambda *args, **kwargs: StubConnection(row_count)):
+            results.append({
+                'benchmark': 'streaming_memory', 'rows': row_count,
+                'get_records_kb': _peak_memory(lambda: consume(hook.get_records('select * from events;'))),
+                'iter_records_kb': _peak_memory(
+                    lambda: consume(hook.iter_records('select * from events;', batch_size=1000)))})
+    return results
+
+
+# Stack depths of the annotated call site, from a shallow script to an operator running inside an Airflow task
+STACK_DEPTHS = (10, 50)
+
+
+def _at_depth(depth, func):
+    """ Calls `func` with `depth` more frames on the stack """
+
+    if depth <= 0:
+        return func()
+    return _at_depth(depth - 1, func)
+
+
+def bench_inspector():
+    """ Measures inspector() at the stack depths of a task, against inspecting the stack with inspect.stack() """
+
+    def annotated_call():
+        return intermix.inspector()
+
+    results = []
+    for depth in STACK_DEPTHS:
+        results.append({
+            'benchmark': 'inspector', 'depth': depth,
+            'per_call_us': _time_us(lambda: _at_depth(depth, annotated_call)),
+            'inspect_stack_us': _time_us(lambda: _at_depth(depth, inspect.stack))})
+    return results
+
+
+def bench_annotator():
+    """ Measures annotator() for hook and operator annotations of each encoding version, against serializing the
+    whole blob on every call as prior annotations are
+    """
+
+    operator = PostgresOperator(sql='select 1;', task_id='load_daily_events', pool='redshift')
+    results = []
+    for case, _self in (('hook', None), ('operator', operator)):
+        for version in (1, 2):
+            with patch.object(intermix, 'ANNOTATION_VERSION', version):
+                results.append({'benchmark': 'annotator', 'case': case, 'version': version,
+                                'per_call_us': _time_us(lambda: intermix.annotator(INSPECTED, _self))})
+            results.append({'benchmark': 'annotator', 'case': case, 'version': version, 'encoding': 'full',
+                            'per_call_us': _time_us(
+                                lambda: intermix._encode_blob(intermix._blob(INSPECTED, _self), version))})
+    return results
+
+
+@contextmanager
+def _stub_connections():
+    """ Makes psycopg2 connect to a StubConnection, so the patched PostgresHook and PostgresOperator run end to end """
+
+    with patch.object(psycopg2, 'connect', lambda *args, **kwargs: StubConnection(1)):
+        yield
+
+
+@contextmanager
+def _unpatched(*classes):
+    """ Restores the original methods of patched classes within the block, to time their calls without annotation """
+
+    for cls in classes:
+        intermix.disable_annotation(cls)
+    try:
+        yield
+    finally:
+        for cls in classes:
+            kind, options = intermix._registry[cls.__module__][cls.__name__]
+            intermix._patch_class(cls, kind, options)
+
+
+def _overhead(result, per_call_us, original_us, count=1):
+    """ Adds the time of a patched call, of the original call and the difference between them to a result """
+
+    result.update({'per_call_us': per_call_us, 'original_us': original_us,
+                   'overhead_us': round(per_call_us - original_us, 2),
+                   'per_statement_overhead_us': round((per_call_us - original_us) / count, 2)})
+    return result
+
+
+# The ways of running the patched calls: as they are, with pooled connections and with batched statement lists
+HOOK_MODES = ('plain', 'pooled', 'batched')
+
+
+@contextmanager
+def _mode(mode):
+    """ Runs the block in one of HOOK_MODES """
+
+    if mode == 'pooled':
+        with intermix.pooled_connections():
+            yield
+    elif mode == 'batched':
+        with patch.object(intermix, 'BATCH_STATEMENTS', True):
+            yield
+    else:
+        yield
+
+
+def bench_execute_appended():
+    """ Measures PostgresOperator.execute from 100 byte to 4,000,000 character statements, with and without an
+    annotation from a previous try, against the unpatched operator and hook. With `pooled`, the connections of the
+    task are pooled.
+    """
+
+    operator = PostgresOperator(sql='', task_id='load_daily_events')
+    blob = intermix.annotator(INSPECTED)
+
+    def execute(statement):
+        operator.sql = statement
+        operator.execute(None)
+
+    results = []
+    with _stub_connections():
+        for size in (100,) + STATEMENT_SIZES:
+            sql = _statement(size)
+            for case, statement in (('unannotated', sql), ('annotated', blob + sql)):
+                with _unpatched(PostgresOperator, PostgresHook):
+                    original_us = _time_us(lambda: _at_depth(50, lambda: execute(statement)))
+                for mode in ('plain', 'pooled'):
+                    with patch.object(intermix, 'POOL_CONNECTIONS', mode == 'pooled'):
+                        per_call_us = _time_us(lambda: _at_depth(50, lambda: execute(statement)))
+                    results.append(_overhead({'benchmark': 'execute_appended', 'case': case, 'mode': mode,
+                                              'size': size}, per_call_us, original_us))
+    return results
+
+
+def bench_hook_lists():
+    """ Measures PostgresHook.run and get_records with lists of 1 to 1000 statements against the unpatched hook, with
+    connections pooled by pooled_connections() and, for run, with BATCH_STATEMENTS
+    """
+
+    hook = PostgresHook(postgres_conn_id='postgres_default')
+    results = []
+    with _stub_connections():
+        for method in ('run', 'get_records'):
+            call = getattr(hook, method)
+            for count in (1, 10, 100, 1000):
+                sql = [_statement(100)] * count
+                with _unpatched(PostgresHook):
+                    original_us = _time_us(lambda: _at_depth(50, lambda: getattr(hook, method)(sql)))
+                for mode in HOOK_MODES:
+                    if mode == 'batched' and method != 'run':
+                        continue
+                    with _mode(mode):
+                        per_call_us = _time_us(lambda: _at_depth(50, lambda: call(sql)))
+                    results.append(_overhead({'benchmark': 'hook_lists', 'method': method, 'mode': mode,
+                                              'statements': count}, per_call_us, original_us, count))
+    return results
+
+
+def _import_us(code, runs=9):
+    """ Returns the calibrated time, in microseconds, of the statements in `code` in a fresh interpreter over `runs`
+    runs, see _calibrated()
+    """
+
+    timed = 'import time; started = time.time(); {}; print((time.time() - started) * 1e6)'.format(code)
+    cwd = os.path.dirname(os.path.realpath(intermix.__file__))
+    return _calibrated(lambda: float(subprocess.check_output([sys.executable, '-c', timed], cwd=cwd)), runs)
+
+
+def bench_import_time():
+    """ Measures importing the plugin on its own, and the cost of patching PostgresHook and PostgresOperator when
+    they are imported
+    """
+
+    airflow_imports = ('from airflow.hooks.postgres_hook import PostgresHook; '
+                       'from airflow.operators.postgres_operator import PostgresOperator')
+    return [{'benchmark': 'import_time',
+             'import_us': _import_us('import intermix'),
+             'airflow_us': _import_us(airflow_imports),
+             'patched_airflow_us': _import_us('import intermix; {}'.format(airflow_imports))}]
+
+
+BENCHMARKS = (bench_import_time, bench_annotation_size, bench_inspector, bench_annotator,
+              bench_prior_annotation_detection, bench_fingerprint, bench_split_statements, bench_execute_appended,
+              bench_hook_lists, bench_streaming_memory)
+
+# The metrics compared against a baseline, all of which are better when lower. Overheads are differences of two
+#   timings, and so twice as noisy, so only the timings they are the difference of are checked.
+CHECKED_METRICS = ('import_us', 'per_call_us', 'anchored_us', 'iter_records_kb', 'v1_bytes', 'v2_bytes')
+
+# The settings a benchmark may change, which are restored after it
+SETTINGS = ('ANNOTATION_VERSION', 'FINGERPRINT_STATEMENTS', 'BATCH_STATEMENTS', 'SPLIT_SCRIPTS', 'POOL_CONNECTIONS')
+
+
+@contextmanager
+def _isolated():
+    """ Runs a benchmark with empty caches and no sampling policies, restoring the registered and patched classes and
+    the settings afterwards, so it measures the same whether or not other benchmarks ran before it
+    """
+
+    settings = dict((name, getattr(intermix, name)) for name in SETTINGS)
+    registry = dict((module, dict(classes)) for module, classes in intermix._registry.items())
+    patched = dict(intermix._patched)
+    wrappers = dict((cls, dict((attribute, vars(cls)[attribute]) for attribute in originals))
+                    for cls, originals in patched.items())
+    policies = dict(intermix._sampling_policies)
+    for cache in (intermix._call_site_cache, intermix._call_site_fragments, intermix._fingerprint_cache,
+                  intermix._sampling_policies):
+        cache.clear()
+    gc.collect()
+    try:
+        yield
+    finally:
+        for cls in list(intermix._patched):
+            if cls not in patched:
+                intermix.disable_annotation(cls)
+        for cls, attributes in wrappers.items():
+            for attribute, wrapper in attributes.items():
+                setattr(cls, attribute, wrapper)
+        intermix._patched.clear()
+        intermix._patched.update(patched)
+        intermix._registry.clear()
+        intermix._registry.update(registry)
+        intermix._sampling_policies.clear()
+        intermix._sampling_policies.update(policies)
+        for name, value in settings.items():
+            setattr(intermix, name, value)
+
+
+def _case(result):
+    """ The fields that identify a result, as opposed to its measurements """
+
+    return tuple(sorted((key, value) for key, value in result.items()
+                        if not key.endswith(('_us', '_kb', '_bytes')) and not isinstance(value, float)))
+
+
+def compare(baseline, results, threshold, min_delta):
+    """ Returns a description of each checked metric that is more than `threshold` times, and more than
+    `min_delta`, worse than in the baseline. Baseline timings are first scaled by the ratio of the reference loop
+    times of the two runs.
+    """
+
+    baseline = dict((_case(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        base = baseline.get(_case(result))
+        if base is None:
+            continue
+        scale = 1.0
+        if result.get('reference_us') and base.get('reference_us'):
+            scale = float(result['reference_us']) / base['reference_us']
+        for metric in CHECKED_METRICS:
+            if metric not in result or metric not in base:
+                continue
+            expected = base[metric] * scale if metric.endswith('_us') else base[metric]
+            if result[metric] > expected * (1 + threshold) and result[metric] - expected > min_delta:
+                regressions.append('{} {}: {} -> {} (calibrated baseline {})'.format(
+                    ', '.join('{}={}'.format(key, value) for key, value in _case(result)), metric, base[metric],
+                    result[metric], round(expected, 2)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the intermix annotation hot path')
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run, such as hook_lists')
+    parser.add_argument('--save', help='file to save the results to as a JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results against')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='relative regression allowed before the comparison fails (default: 0.5)')
+    parser.add_argument('--min-delta', type=float, default=1.0,
+                        help='absolute regression always allowed, to ignore noise in tiny timings (default: 1.0)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.__name__[len('bench_'):] not in args.only:
+            continue
+        with _isolated():
+            benchmark_results = benchmark()
+        for result in benchmark_results:
+            result['reference_us'] = _calibration_us()
+            print(', '.join('{}={}'.format(key, value) for key, value in sorted(result.items())))
+            results.append(result)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.threshold, args.min_delta)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,309 +23,2197 @@
 # SOFTWARE.
 #
 from __future__ import unicode_literals
-from future import standard_library
-standard_library.install_aliases()
 
+import atexit
 import base64
-from builtins import str
-from datetime import datetime
-import inspect
+import bisect
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+import hashlib
+from importlib import import_module
 import json
+import numbers
 import os
 import sys
 import re
+import socket
+import threading
+import time
 import traceback
+import uuid
+import warnings
 
-from airflow import __version__ as AIRFLOW_VERSION
-from airflow.hooks.postgres_hook import PostgresHook
-from airflow.operators.postgres_operator import PostgresOperator
-
-# Patch S3ToRedshiftOperator in RedshiftPlugin, if it exists
-in_path = True
-this_parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# Importing the plugin has no side effects beyond installing an import hook. Airflow and the RedshiftPlugin are only
+#   patched once they are imported, see install().
 try:
-    # Ensure the local plugin folder is in the path
-    if this_parent_path not in sys.path:
-        in_path = False
-        sys.path.append(this_parent_path)
-    from RedshiftPlugin.operators.s3_to_redshift import S3ToRedshiftOperator
-    PATCH_S3_TO_REDSHIFT = True
-except ImportError:
-    PATCH_S3_TO_REDSHIFT = False
-finally:
-    if not in_path:
-        sys.path.remove(this_parent_path)
+    # Python 2, where text is unicode
+    str = unicode
+except NameError:
+    pass
 
 try:
     basestring
 except NameError:
     basestring = str
 
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    # Python 2
+    from Queue import Empty, Full, Queue
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    # Python 2, which uses the find_module/load_module import hook protocol
+    find_spec = None
+
 __PLUGIN_ID__ = 'intermix-airflow-plugin'
 __VERSION__ = '0.4'
 
-# The existing Postgres operator and hook methods
-old_pg_execute = PostgresOperator.execute
-old_get_first = PostgresHook.get_first
-old_get_records = PostgresHook.get_records
-old_run = PostgresHook.run
-if PATCH_S3_TO_REDSHIFT:
-    old_s3_rs_execute = S3ToRedshiftOperator.execute
+# Airflow's plugin manager loads the plugin under a mangled module name, while DAG code imports it as intermix. The
+#   first copy loaded is made the intermix module, and a copy loaded after it replaces itself with that one, so the
+#   import hook, the patches and all the settings live in a single module.
+_intermix = sys.modules.get('intermix')
+_this_module = sys.modules.get(__name__)
+if _this_module is not None and vars(_this_module) is not globals():
+    _this_module = None
+if _intermix is None and _this_module is not None and __name__ != '__main__':
+    _intermix = sys.modules['intermix'] = _this_module
+# Whether this copy was replaced by the intermix module, in which case it doesn't patch or install anything itself
+_REPLACED = (_this_module is not None and _intermix is not _this_module and __name__ not in ('intermix', '__main__')
+             and getattr(_intermix, '__PLUGIN_ID__', None) == __PLUGIN_ID__)
+if _REPLACED:
+    sys.modules[__name__] = _intermix
+
+# Whether the S3ToRedshiftOperator of the RedshiftPlugin has been patched
+PATCH_S3_TO_REDSHIFT = False
+
+
+def _env_flag(name):
+    """ Reads an on/off setting from the environment """
+
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def _airflow_version():
+    """ Reads the Airflow version when it is first needed, so that importing the plugin doesn't import Airflow """
+
+    from airflow import __version__ as AIRFLOW_VERSION
+    return str(AIRFLOW_VERSION)
 
 
 INTERMIX_RE = re.compile(r"(\s*/\* INTERMIX_ID.*?\*/)", re.UNICODE)
 
+# Annotations are prepended to statements, so they are only looked for within this many characters of the start
+ANNOTATION_LOOKAHEAD = 65536
 
-def inspector():
-    """ Stack inspector to obtain runtime metadata for annotation """
 
-    the_file = ''
+def match_annotation(sql):
+    """ Matches INTERMIX_RE against the head of a statement, so the cost doesn't grow with the statement length """
+
+    return INTERMIX_RE.match(sql, 0, ANNOTATION_LOOKAHEAD)
+
+
+def _statement_start(sql, match):
+    """ Returns where the statement annotated by a match of INTERMIX_RE starts, after the space that follows the
+    annotation. This is the statement the annotation was built for, and whose fingerprint it holds.
+    """
+
+    start = match.end()
+    if sql.startswith(' ', start):
+        start += 1
+    return start
+
+
+# Resolved call-site metadata keyed by (code object, line number, class), evicted least recently used first
+CALL_SITE_CACHE_SIZE = 1024
+_call_site_cache = OrderedDict()
+_call_site_lock = threading.Lock()
+
+
+def _resolve_call_site(frame):
+    """ Resolves the annotation metadata of a frame, using the call-site cache where possible """
+
+    frame_locals = frame.f_locals
+    the_class = frame_locals.get('self')
+    if the_class is not None:
+        the_class = the_class.__class__
+    else:
+        the_class = frame_locals.get('cls')
+
+    code = frame.f_code
+    key = (code, frame.f_lineno, the_class)
+    with _call_site_lock:
+        resolved = _call_site_cache.pop(key, None)
+        if resolved is not None:
+            # Re-insert to mark as most recently used
+            _call_site_cache[key] = resolved
+            return resolved
+
     the_module = '__main__'
-    the_class = ''
-    the_function = ''
-    the_linenumber = ''
+    class_name = ''
+    if the_class:
+        the_module = the_class.__module__
+        class_name = the_class.__name__
+    resolved = (code.co_filename, the_module, class_name, code.co_name, str(frame.f_lineno))
+
+    with _call_site_lock:
+        _call_site_cache[key] = resolved
+        while len(_call_site_cache) > CALL_SITE_CACHE_SIZE:
+            _call_site_cache.popitem(last=False)
+    return resolved
+
+
+def inspector():
+    """ Stack inspector to obtain runtime metadata for annotation """
 
     try:
-        previous_frame = inspect.currentframe().f_back.f_back
+        # Walk the frames directly rather than through inspect, which loads source context for every frame
+        previous_frame = sys._getframe(2)
         try:
-            the_file, the_linenumber, the_function, lines, index = inspect.getframeinfo(previous_frame)
-            the_linenumber = str(the_linenumber)
+            return _resolve_call_site(previous_frame)
         finally:
             # Keeping references to frame objects can create reference cycles, so we make removal deterministic
             del previous_frame
+    except:
+        traceback.print_exc()
+
+    return ('', '__main__', '', '', '')
+
+
+# Operator attributes included in the blob and the keys they are stored under
+OPERATOR_FIELDS = (('owner', 'owner'), ('run_as_user', 'run_as_user'), ('dag_id', 'dag'), ('task_id', 'task'),
+                   ('pool', 'pool'), ('queue', 'queue'))
+
+ANNOTATION_FORMAT = "/* INTERMIX_ID: {} */ "
+
+# The compact encoding marks its payload with a prefix that can't start a version 1 payload, which always starts
+#   with the encoding of '{"'. It has short keys, leaves out empty fields and the plugin and app names, which are
+#   implied by the marker, has integer timestamps in epoch milliseconds and drops the base64 padding.
+V2_MARKER = 'v2.'
+V2_KEYS = {'plugin_ver': 'pv', 'app_ver': 'av', 'at': 't', 'file': 'f', 'module': 'm', 'classname': 'c',
+           'function': 'fn', 'linenumber': 'l', 'owner': 'o', 'run_as_user': 'u', 'dag': 'd', 'task': 'tk',
+           'pool': 'pl', 'queue': 'q', 'statement_index': 'i', 'fingerprint': 'fp'}
+V1_KEYS = dict((short_key, key) for key, short_key in V2_KEYS.items())
+
+# JSON (item, key) separators for each encoding version
+_JSON_SEPARATORS = {1: (', ', ': '), 2: (',', ':')}
+
+
+def _env_annotation_version():
+    """ Reads the annotation encoding version from the environment, falling back to version 1 with a warning when it
+    isn't one of the versions there are
+    """
+
+    value = os.environ.get('INTERMIX_ANNOTATION_VERSION', '1')
+    try:
+        version = int(value)
+    except ValueError:
+        version = None
+    if version not in _JSON_SEPARATORS:
+        warnings.warn('INTERMIX_ANNOTATION_VERSION {!r} is not one of {}, using version 1'.format(
+            value, ', '.join(str(known) for known in sorted(_JSON_SEPARATORS))))
+        return 1
+    return version
 
-        stack = inspect.stack()
+
+# The annotation encoding, 1 for base64 encoded JSON or 2 for the compact encoding
+ANNOTATION_VERSION = _env_annotation_version()
+
+# The payload of the marker sent in place of the annotation by calls a SamplingPolicy skips. It is too short to be
+#   the payload of a blob of either version.
+SAMPLED_MARKER = 's'
+SAMPLED_ANNOTATION = ANNOTATION_FORMAT.format(SAMPLED_MARKER)
+
+_EPOCH = datetime(1970, 1, 1)
+
+# The encoded per-process heads of the blob by encoding version, see _encoded_head()
+_process_heads = {}
+
+
+def _epoch_ms(at):
+    """ Converts an ISO 8601 annotation timestamp to epoch milliseconds """
+
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
         try:
-            the_class = stack[2][0].f_locals["self"].__class__
-        except KeyError:
-            try:
-                the_class = stack[2][0].f_locals["cls"]
-            except KeyError:
-                pass
+            delta = datetime.strptime(at, time_format) - _EPOCH
+        except ValueError:
+            continue
+        return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    return at
 
-        if the_class:
-            the_module = the_class.__module__
-            the_class = the_class.__name__
 
-    except:
-        traceback.print_exc()
+def _serialize(fields, version):
+    """ Serializes blob fields without the enclosing braces, so they can be spliced into a JSON object """
+
+    if version == 2:
+        fields = dict((V2_KEYS.get(key, key), value) for key, value in fields.items() if value not in ('', None))
+    return json.dumps(fields, separators=_JSON_SEPARATORS[version])[1:-1]
+
+
+def _b64encode(data, version):
+    """ Base64 encodes the tail of a blob, dropping the padding for the compact encoding """
+
+    encoded = base64.b64encode(data).decode()
+    if version == 2:
+        return encoded.rstrip('=')
+    return encoded
+
+
+def _format(encoded, version):
+    """ Formats an encoded blob as an annotation comment """
+
+    if version == 2:
+        return ANNOTATION_FORMAT.format(V2_MARKER + encoded)
+    return ANNOTATION_FORMAT.format(encoded)
 
-    return (the_file, the_module, the_class, the_function, the_linenumber)
+
+def decode_annotation(annotation):
+    """ Decodes the annotation at the head of a statement, or an annotation comment on its own, of either encoding
+    version. The blob is returned with the version 1 keys and values, or None if there is no annotation.
+    """
+
+    match = match_annotation(annotation)
+    if not match:
+        return None
+    payload = match.groups()[0].strip()[16:-3]
+    if payload == SAMPLED_MARKER:
+        return {}
+    if not payload.startswith(V2_MARKER):
+        return json.loads(base64.b64decode(payload).decode())
+
+    payload = payload[len(V2_MARKER):]
+    parsed = json.loads(base64.b64decode(payload + '=' * (-len(payload) % 4)).decode())
+    blob = {'plugin': __PLUGIN_ID__, 'app': 'airflow', 'file': '', 'module': '', 'classname': '', 'function': '',
+            'linenumber': ''}
+    for key, value in parsed.items():
+        blob[V1_KEYS.get(key, key)] = value
+    if isinstance(blob.get('at'), numbers.Integral):
+        blob['at'] = (_EPOCH + timedelta(milliseconds=blob['at'])).isoformat()+'Z'
+    if isinstance(blob['linenumber'], numbers.Integral):
+        blob['linenumber'] = str(blob['linenumber'])
+    return blob
+
+
+# Whether annotations include a fingerprint of their statement with its literals stripped, see fingerprint()
+FINGERPRINT_STATEMENTS = _env_flag('INTERMIX_FINGERPRINT')
+# Characters at the head of a statement that are normalized for its fingerprint, which bounds the cost on statements
+#   of up to the 4,000,000 character cap. Longer statements are identified by their head.
+FINGERPRINT_LIMIT = int(os.environ.get('INTERMIX_FINGERPRINT_LIMIT', 16384))
+FINGERPRINT_CACHE_SIZE = 128
+
+# String, dollar-quoted and numeric literals, and comments, which a single substitution replaces with '?'. Every
+#   alternative starts with a character of the leading set, so the scan skips quickly over the text between them.
+_LITERAL_RE = re.compile(r"[-'$/0-9](?:(?<=')[^']*(?:''[^']*)*'|(?<=\$)(\w*)\$.*?\$\1\$"
+                         r"|(?<=[0-9])(?<![\w.][0-9])[0-9]*(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?\b|(?<=-)-[^\n]*"
+                         r"|(?<=/)\*.*?\*/)", re.DOTALL | re.UNICODE)
+
+# Recent fingerprints by the identity of their statement, for sensors that resend the same statement. The statement is
+#   held with its fingerprint so its id can't be reused while it's cached.
+_fingerprint_cache = OrderedDict()
+_fingerprint_lock = threading.Lock()
 
 
-def annotator(inspected, _self=None, prior_annotation=None):
-    """ Top level annotation string creation function """
+def fingerprint(statement):
+    """ Returns a fingerprint of a statement with its literals and comments stripped, so the statements of a query
+    that only differ in their values share it. Only the head of the statement up to FINGERPRINT_LIMIT characters is
+    normalized.
+    """
+
+    key = id(statement)
+    cached = _fingerprint_cache.get(key)
+    if cached is not None and cached[0] is statement:
+        return cached[1]
+
+    digest = hashlib.sha1(_LITERAL_RE.sub('?', statement[:FINGERPRINT_LIMIT]).strip().encode('utf-8')).hexdigest()[:16]
+    if len(statement) <= FINGERPRINT_LIMIT:
+        with _fingerprint_lock:
+            _fingerprint_cache[key] = (statement, digest)
+            if len(_fingerprint_cache) > FINGERPRINT_CACHE_SIZE:
+                _fingerprint_cache.popitem(last=False)
+    return digest
+
+
+def _blob(inspected, _self=None, prior_annotation=None, statement=None, drop=()):
+    """ Builds the metadata dictionary that is serialized into an annotation """
 
     the_file, the_module, the_class, the_function, the_linenumber = inspected
     blob = {'plugin': __PLUGIN_ID__, 'plugin_ver': __VERSION__, 'app': 'airflow',
-            'app_ver': str(AIRFLOW_VERSION), 'at': datetime.utcnow().isoformat()+'Z',
+            'app_ver': _airflow_version(), 'at': datetime.utcnow().isoformat()+'Z',
             'file': the_file, 'module': the_module, 'classname': the_class, 'function': the_function,
             'linenumber': the_linenumber}
     if _self:
-        for key in ('owner', 'run_as_user', 'dag_id', 'task_id', 'pool', 'queue'):
+        for key, mapped_key in OPERATOR_FIELDS:
             key_attr = getattr(_self, key)
             if key_attr:
-                mapped_key = {'dag_id': 'dag', 'task_id': 'task'}.get(key, key)
                 blob.update({mapped_key: str(key_attr)})
+    if statement is not None:
+        blob['fingerprint'] = fingerprint(statement)
 
     # If there is already an annotation, keep these values
     if prior_annotation:
-        match_str = prior_annotation.groups()[0].strip()[16:-3]
-        parsed = json.loads(base64.b64decode(match_str))
-        blob.update(parsed)
+        blob.update(decode_annotation(prior_annotation.groups()[0]))
+    for key in drop:
+        blob.pop(key, None)
+
+    return blob
+
+
+def _encode_blob(blob, version):
+    """ Encodes a complete metadata dictionary as an annotation """
+
+    if version == 2:
+        blob = dict(blob)
+        for key, constant in (('plugin', __PLUGIN_ID__), ('app', 'airflow')):
+            if blob.get(key) == constant:
+                del blob[key]
+        if 'at' in blob:
+            blob['at'] = _epoch_ms(blob['at'])
+        if str(blob.get('linenumber', '')).isdigit():
+            blob['linenumber'] = int(blob['linenumber'])
 
     # Encode/decode for Python 2/3 compatiblity
-    return "/* INTERMIX_ID: {} */ ".format(base64.b64encode(json.dumps(blob).encode()).decode())
+    return _format(_b64encode('{{{}}}'.format(_serialize(blob, version)).encode(), version), version)
 
 
-def pg_execute_appended(self, context):
-    """ Appends a metadata blob as a comment to the front of the query before it is executed.
+def _encode_aligned(encoded, data):
+    """ Base64 encodes each 3 bytes independently, so the 3-byte aligned part of `data` can be encoded ahead of the
+    rest of the blob. Returns the extended encoding and the bytes that still need to be encoded.
     """
 
-    try:
-        prior_annotation = re.search(INTERMIX_RE, self.sql)
-        if prior_annotation:
-            self.sql = re.sub(INTERMIX_RE, '', self.sql)
-        blob = annotator(inspector(), self, prior_annotation)
-        # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case scenario of
-        #   4000000 4-byte characters.
-        if len(blob) + len(self.sql) <= 4000000:
-            self.sql = '{}{}'.format(blob, self.sql)
-    except:
-        # If anything raises an exception, we still want it to continue executing as normal
-        traceback.print_exc()
+    aligned = len(data) - len(data) % 3
+    return encoded + base64.b64encode(data[:aligned]).decode(), data[aligned:]
+
+
+def _encoded_head(_self=None, version=1):
+    """ Returns the encoded head of the blob holding the per-process constants and, if given, the operator fields,
+    along with its unencoded remainder. The serialized JSON object is left open for the call-site fields.
+    """
 
-    return old_pg_execute(self, context)
+    head = _process_heads.get(version)
+    if head is None:
+        fields = {'plugin_ver': __VERSION__, 'app_ver': _airflow_version()}
+        if version == 1:
+            fields.update({'plugin': __PLUGIN_ID__, 'app': 'airflow'})
+        fields = '{{{}'.format(_serialize(fields, version))
+        head = _process_heads[version] = (fields, _encode_aligned('', fields.encode()))
+    if not _self:
+        return head[1]
+
+    # Operator fields rarely change, so the encoded head is cached on the operator for as long as they don't
+    values = (version,) + tuple(getattr(_self, key) for key, mapped_key in OPERATOR_FIELDS)
+    cached = getattr(_self, '_intermix_head', None)
+    if cached is None or cached[0] != values:
+        fields = head[0]
+        operator_fields = dict((mapped_key, str(value)) for (key, mapped_key), value in zip(OPERATOR_FIELDS, values[1:])
+                               if value)
+        if operator_fields:
+            fields = '{}{}{}'.format(fields, _JSON_SEPARATORS[version][0], _serialize(operator_fields, version))
+        cached = (values, _encode_aligned('', fields.encode()))
+        try:
+            _self._intermix_head = cached
+        except AttributeError:
+            pass
+    return cached[1]
+
+
+# The serialized constant fields of each call site, keyed by the call site, encoding version and dropped fields
+_call_site_fragments = {}
 
 
-def pg_get_first(self, sql, parameters=None):
-    """ Appends a metadata blob as a comment to the front of the query before it is executed.
+def _call_site_fragment(inspected, version, drop):
+    """ Serializes the fields of a call site, less those to `drop`, which are the same for all of its calls """
+
+    key = (inspected, version, drop)
+    fragment = _call_site_fragments.get(key)
+    if fragment is None:
+        the_file, the_module, the_class, the_function, the_linenumber = inspected
+        if version == 2 and the_linenumber:
+            the_linenumber = int(the_linenumber)
+        fields = {'file': the_file, 'module': the_module, 'classname': the_class, 'function': the_function,
+                  'linenumber': the_linenumber}
+        for field in drop:
+            fields.pop(field, None)
+        fragment = _serialize(fields, version)
+        if fragment:
+            fragment = '{}{}'.format(_JSON_SEPARATORS[version][0], fragment)
+        if len(_call_site_fragments) >= CALL_SITE_CACHE_SIZE:
+            _call_site_fragments.clear()
+        _call_site_fragments[key] = fragment
+    return fragment
+
+
+def _call_site_fields(inspected, version=1, drop=()):
+    """ Serializes the fields that change on every call, less those to `drop`, to be appended to the head of the
+    blob. Only the timestamp is serialized on every call, the other fields once for each call site.
     """
-    sql_is_string = False
-    if isinstance(sql, basestring):
-        sql_is_string = True
-        sql = [sql]
 
-    new_sql = []
-    try:
-        for _sql in sql:
-            if '/* INTERMIX_ID:' not in _sql:
-                blob = annotator(inspector())
-                # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case scenario of
-                #   4000000 4-byte characters.
-                if len(blob) + len(_sql) <= 4000000:
-                    new_sql.append('{}{}'.format(blob, _sql))
-                else:
-                    new_sql.append(_sql)
-            else:
-                new_sql.append(_sql)
-    except:
-        # If anything raises an exception, we still want it to continue executing as normal
-        traceback.print_exc()
-        if len(new_sql) < len(sql):
-            new_sql = sql
+    if version == 2:
+        at = '"t":{}'.format(int(time.time() * 1000))
+    else:
+        at = '"at": "{}Z"'.format(datetime.utcnow().isoformat())
+    return '{}{}{}'.format(_JSON_SEPARATORS[version][0], at, _call_site_fragment(inspected, version, drop)).encode()
 
-    if sql_is_string:
-        new_sql = new_sql[0]
-    return old_get_first(self, new_sql, parameters=parameters)
 
+def _statement_fields(version, index=None, statement=None):
+    """ Serializes the fields of a single statement, to be appended to the call-site fields """
+
+    fields = {}
+    if index is not None:
+        fields['statement_index'] = index
+    if statement is not None and FINGERPRINT_STATEMENTS:
+        fields['fingerprint'] = fingerprint(statement)
+    if not fields:
+        return b''
+    return '{}{}'.format(_JSON_SEPARATORS[version][0], _serialize(fields, version)).encode()
 
-def pg_get_records(self, sql, parameters=None):
-    """ Appends a metadata blob as a comment to the front of the query before it is executed.
+
+def annotator(inspected, _self=None, prior_annotation=None, statement=None, drop=()):
+    """ Top level annotation string creation function. With FINGERPRINT_STATEMENTS, the fingerprint of `statement`,
+    given without any annotation, is included. The call-site fields in `drop` are left out.
     """
-    sql_is_string = False
-    if isinstance(sql, basestring):
-        sql_is_string = True
-        sql = [sql]
 
-    new_sql = []
-    try:
-        for _sql in sql:
-            if '/* INTERMIX_ID:' not in _sql:
-                blob = annotator(inspector())
-                # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case scenario of
-                #   4000000 4-byte characters.
-                if len(blob) + len(_sql) <= 4000000:
-                    new_sql.append('{}{}'.format(blob, _sql))
-                else:
-                    new_sql.append(_sql)
-            else:
-                new_sql.append(_sql)
-    except:
-        # If anything raises an exception, we still want it to continue executing as normal
-        traceback.print_exc()
-        if len(new_sql) < len(sql):
-            new_sql = sql
+    version = ANNOTATION_VERSION
+    if prior_annotation:
+        statement = statement if FINGERPRINT_STATEMENTS else None
+        return _encode_blob(_blob(inspected, _self, prior_annotation, statement, drop), version)
 
-    if sql_is_string:
-        new_sql = new_sql[0]
-    return old_get_records(self, new_sql, parameters=parameters)
+    encoded, remainder = _encoded_head(_self, version)
+    tail = (remainder + _call_site_fields(inspected, version, drop) + _statement_fields(version, statement=statement) +
+            b'}')
+    return _format(encoded + _b64encode(tail, version), version)
 
 
-def pg_run(self, sql, autocommit=False, parameters=None):
-    """ Appends a metadata blob as a comment to the front of the query before it is executed.
+def batch_annotator(inspected, count, _self=None, statements=None, drop=(), indexes=None):
+    """ Creates the annotation strings for a batch of `count` statements issued from the same call site. The shared
+    metadata is serialized once and each statement only adds its index, and its fingerprint if the `statements` are
+    given. The indexes are the positions within the batch, or the `indexes` given for each statement. The call-site
+    fields in `drop` are left out.
     """
-    sql_is_string = False
-    if isinstance(sql, basestring):
-        sql_is_string = True
+
+    if count == 1 and indexes is None:
+        return [annotator(inspected, _self, statement=statements[0] if statements else None, drop=drop)]
+
+    version = ANNOTATION_VERSION
+    indexes = range(count) if indexes is None else indexes
+    encoded, remainder = _encoded_head(_self, version)
+    encoded, remainder = _encode_aligned(encoded, remainder + _call_site_fields(inspected, version, drop))
+    if statements is None or not FINGERPRINT_STATEMENTS:
+        index_field = '{}{}'.format(_JSON_SEPARATORS[version][0], _serialize({'statement_index': 0}, version)[:-1])
+        return [_format(encoded + _b64encode(remainder + '{}{}}}'.format(index_field, index).encode(), version),
+                        version)
+                for index in indexes]
+    return [_format(encoded + _b64encode(remainder + _statement_fields(version, index, statement) + b'}', version),
+                    version)
+            for index, statement in zip(indexes, statements)]
+
+
+class SamplingPolicy(object):
+    """ Decides which calls from a call site get a full annotation, the others get the short SAMPLED_ANNOTATION
+    marker. The first `first` calls are annotated, after which a call is annotated if it is one in every `every`
+    calls or if no call has been annotated for `interval` seconds.
+    """
+
+    def __init__(self, first=1, every=None, interval=None):
+        self.first = first
+        self.every = every
+        self.interval = interval
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def sample(self, key):
+        """ Returns whether the call from `key` should be annotated """
+
+        now = time.time()
+        with self._lock:
+            calls = self._calls.get(key)
+            if calls is None:
+                calls = self._calls[key] = [0, None]
+            count, annotated_at = calls
+            calls[0] += 1
+            if (count < self.first or
+                    (self.every and (count - self.first) % self.every == 0) or
+                    (self.interval is not None and (annotated_at is None or now - annotated_at >= self.interval))):
+                calls[1] = now
+                return True
+        return False
+
+
+# Sampling policies keyed by the scope they apply to, see set_sampling_policy()
+_sampling_policies = {}
+
+
+def _env_sampling_policy():
+    """ Reads the default sampling policy from the environment, if one is set """
+
+    first = os.environ.get('INTERMIX_SAMPLE_FIRST')
+    every = os.environ.get('INTERMIX_SAMPLE_EVERY')
+    interval = os.environ.get('INTERMIX_SAMPLE_INTERVAL')
+    if first is None and every is None and interval is None:
+        return None
+    return SamplingPolicy(first=int(first or 1), every=int(every) if every else None,
+                          interval=float(interval) if interval else None)
+
+
+def set_sampling_policy(policy, dag_id=None, task_id=None, call_site=None):
+    """ Sets the SamplingPolicy for the calls from a call site, given as a (file, line number) tuple, the tasks of a
+    DAG, a single task if `task_id` is also given, or by default for all calls if none of those is given. Setting a
+    policy of None removes it.
+    """
+
+    if call_site:
+        key = ('call_site', (call_site[0], str(call_site[1])))
+    elif task_id:
+        key = ('task', (dag_id, task_id))
+    elif dag_id:
+        key = ('dag', dag_id)
+    else:
+        key = ('default', None)
+
+    if policy is None:
+        _sampling_policies.pop(key, None)
+    else:
+        _sampling_policies[key] = policy
+
+
+def sample_annotation(inspected, _self=None):
+    """ Returns whether a call should be annotated in full, according to the most specific policy that applies """
+
+    if not _sampling_policies:
+        return True
+
+    dag_id = getattr(_self, 'dag_id', None)
+    task_id = getattr(_self, 'task_id', None)
+    for key in (('call_site', (inspected[0], inspected[4])), ('task', (dag_id, task_id)), ('dag', dag_id),
+                ('default', None)):
+        policy = _sampling_policies.get(key)
+        if policy is not None:
+            return policy.sample((dag_id, task_id, inspected[0], inspected[4]))
+    return True
+
+
+_default_sampling_policy = _env_sampling_policy()
+if _default_sampling_policy is not None:
+    set_sampling_policy(_default_sampling_policy)
+
+
+# Redshift's limit on the length of a query, in UTF-8 bytes
+QUERY_BYTE_LIMIT = 16 * 1024 * 1024
+
+# The call-site fields left out of an annotation in turn when it doesn't fit in front of its statement, before the
+#   statement is sent without one
+ANNOTATION_DEGRADATIONS = ((), ('file',), ('file', 'classname', 'function'))
+
+_UTF8_CHUNK = 1 << 20
+# Python 3.7+ flags ASCII strings, so they can be measured without encoding them
+_isascii = getattr(str, 'isascii', None)
+_UTF8_ERRORS = 'surrogatepass' if sys.version_info[0] > 2 else 'strict'
+
+
+def utf8_length(text, limit=None):
+    """ Returns the length of `text` encoded as UTF-8, in bytes. Text that isn't flagged as ASCII is encoded a chunk
+    at a time, which stops with a partial length once it is over `limit`.
+    """
+
+    if _isascii is not None and _isascii(text):
+        return len(text)
+    length = 0
+    for start in range(0, len(text), _UTF8_CHUNK):
+        length += len(text[start:start + _UTF8_CHUNK].encode('utf-8', _UTF8_ERRORS))
+        if limit is not None and length > limit:
+            break
+    return length
+
+
+class SizeBudget(object):
+    """ Fits annotations in front of their statements within `limit` UTF-8 bytes. Annotations are ASCII, so only a
+    statement is ever encoded to be measured, at most once, and only when it could be over the limit as 4-byte
+    characters.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = QUERY_BYTE_LIMIT if limit is None else limit
+
+    def fit(self, statement, build, prior_length=0):
+        """ Returns the first of the annotations `build(drop)` makes for each of ANNOTATION_DEGRADATIONS that fits in
+        front of `statement`, less the `prior_length` characters of an annotation it replaces, or None
+        """
+
+        length = None
+        for drop in ANNOTATION_DEGRADATIONS:
+            blob = build(drop)
+            room = self.limit - len(blob)
+            if (len(statement) - prior_length) * 4 <= room:
+                return blob
+            if length is None:
+                # A prior annotation is ASCII, so its characters are bytes
+                length = utf8_length(statement, self.limit + prior_length) - prior_length
+            if length <= room:
+                return blob
+        return None
+
+
+_size_budget = SizeBudget()
+
+
+def _annotate_statements(sql, inspected, _self=None):
+    """ Prepends annotations to a statement or list of statements issued from a single call site. Statements that
+    are already annotated are left untouched.
+    """
+
+    sql_is_string = isinstance(sql, basestring)
+    if sql_is_string:
         sql = [sql]
+    else:
+        # Iterators can only be read once
+        sql = list(sql)
 
-    new_sql = []
+    new_sql = list(sql)
     try:
-        for _sql in sql:
-            if '/* INTERMIX_ID:' not in _sql:
-                blob = annotator(inspector())
-                # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case
-                # scenario of 4000000 4-byte characters.
-                if len(blob) + len(_sql) <= 4000000:
-                    new_sql.append('{}{}'.format(blob, _sql))
-                else:
-                    new_sql.append(_sql)
+        unannotated = [index for index, _sql in enumerate(sql) if not match_annotation(_sql)]
+        if unannotated:
+            statements = [sql[index] for index in unannotated]
+            # The statements of a list are annotated with their positions in it
+            indexes = unannotated if len(sql) > 1 else None
+            if sample_annotation(inspected, _self):
+                batches = {(): batch_annotator(inspected, len(unannotated), _self, statements, indexes=indexes)}
             else:
-                new_sql.append(_sql)
+                batches = dict((drop, [SAMPLED_ANNOTATION] * len(unannotated)) for drop in ANNOTATION_DEGRADATIONS)
+
+            def builder(position):
+                def build(drop):
+                    # The annotations of the whole batch are rebuilt at most once for each degradation
+                    if drop not in batches:
+                        batches[drop] = batch_annotator(inspected, len(unannotated), _self, statements, drop,
+                                                        indexes)
+                    return batches[drop][position]
+                return build
+
+            for position, index in enumerate(unannotated):
+                # Redshift has a 16MB query length limit, so statements near it get a smaller annotation or none
+                blob = _size_budget.fit(sql[index], builder(position))
+                if blob is not None:
+                    new_sql[index] = '{}{}'.format(blob, sql[index])
     except:
         # If anything raises an exception, we still want it to continue executing as normal
         traceback.print_exc()
-        if len(new_sql) < len(sql):
-            new_sql = sql
+        new_sql = sql
 
     if sql_is_string:
-        new_sql = new_sql[0]
-    return old_run(self, new_sql, autocommit=autocommit, parameters=parameters)
+        return new_sql[0]
+    return new_sql
+
+
+# The operator executing on each thread, for the hook wrappers to attribute their queries to. Task threads in the
+#   same process each have their own, so the hooks never need to be patched per operator.
+_task_context = threading.local()
+
+
+@contextmanager
+def operator_scope(operator):
+    """ Attributes the queries made through the patched hooks on the current thread to `operator` within the block """
+
+    previous = getattr(_task_context, 'operator', None)
+    _task_context.operator = operator
+    try:
+        yield
+    finally:
+        _task_context.operator = previous
+
+
+def active_operator():
+    """ Returns the operator that queries on the current thread are attributed to, if any """
+
+    return getattr(_task_context, 'operator', None)
 
 
-def s3_rs_execute(self, context):
-    """ Appends a metadata blob as a comment to the front of the query before it is executed.
+# Share connections between the queries of a task, see pooled_connections()
+POOL_CONNECTIONS = _env_flag('INTERMIX_POOL_CONNECTIONS')
+# Idle connections kept per connection id
+POOL_MAX_IDLE = int(os.environ.get('INTERMIX_POOL_MAX_IDLE', 2))
+# Seconds after which an idle connection is closed rather than reused
+POOL_IDLE_TIMEOUT = float(os.environ.get('INTERMIX_POOL_IDLE_TIMEOUT', 300))
+
+
+class ConnectionPool(object):
+    """ Idle database connections keyed by connection id and database. Connections are created with `factory(hook)`
+    and are handed out wrapped, so closing them returns them to the pool.
     """
 
-    # We need a different 'self' for the correct context for the RedshiftPlugin so we need to use different functions
-    #   here. Unlike in the general case, the S3-to-Redshift Operator does not use any list parameters for 'sql'.
-    def s3_pg_get_first(_self, sql, parameters=None):
-        try:
-            blob = annotator(inspector(), self)
-            # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case scenario of
-            #   4000000 4-byte characters.
-            if len(blob) + len(sql) <= 4000000:
-                sql = '{}{}'.format(blob, sql)
-        except:
-            # If anything raises an exception, we still want it to continue executing as normal
-            traceback.print_exc()
+    def __init__(self, factory, max_idle=None, idle_timeout=None):
+        self.factory = factory
+        self.max_idle = POOL_MAX_IDLE if max_idle is None else max_idle
+        self.idle_timeout = POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.closed = False
+        self._idle = {}
+        self._lock = threading.Lock()
 
-        return old_get_first(_self, sql, parameters=parameters)
+    def acquire(self, key, hook):
+        """ Returns an idle connection for `key`, or a new one from the factory """
 
-    def s3_pg_get_records(_self, sql, parameters=None):
-        try:
-            blob = annotator(inspector(), self)
-            # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case scenario of
-            #   4000000 4-byte characters.
-            if len(blob) + len(sql) <= 4000000:
-                sql = '{}{}'.format(blob, sql)
-        except:
-            # If anything raises an exception, we still want it to continue executing as normal
-            traceback.print_exc()
+        connection = None
+        expired_before = time.time() - self.idle_timeout
+        with self._lock:
+            idle = self._idle.get(key, [])
+            expired = [idle_connection for idle_connection, released_at in idle if released_at <= expired_before]
+            idle[:] = [(idle_connection, released_at) for idle_connection, released_at in idle
+                       if released_at > expired_before]
+            if idle:
+                connection = idle.pop()[0]
+        for expired_connection in expired:
+            _close_quietly(expired_connection)
 
-        return old_get_records(_self, sql, parameters=parameters)
+        if connection is None:
+            connection = self.factory(hook)
+        return _PooledConnection(self, key, connection)
+
+    def release(self, key, connection):
+        """ Returns a connection to the pool, discarding any uncommitted work like closing it would, and restoring the
+        default of not autocommitting
+        """
 
-    def s3_pg_run(_self, sql, autocommit=False, parameters=None):
         try:
-            blob = annotator(inspector(), self)
-            # Redshift has a 16MB query length limit so we won't annotate if the length exceeds a worst case scenario of
-            #   4000000 4-byte characters.
-            if len(blob) + len(sql) <= 4000000:
-                sql = '{}{}'.format(blob, sql)
-        except:
-            # If anything raises an exception, we still want it to continue executing as normal
-            traceback.print_exc()
+            connection.rollback()
+            connection.autocommit = False
+        except Exception:
+            _close_quietly(connection)
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if not self.closed and len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+        _close_quietly(connection)
+
+    def close(self):
+        """ Closes all idle connections. Connections in use are closed when they are released. """
+
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, released_at in connections:
+                _close_quietly(connection)
 
-        return old_run(_self, sql, autocommit=autocommit, parameters=parameters)
 
-    # Patch only for S3ToRedshiftOperator
-    if PostgresHook.get_first.__name__ != 's3_pg_get_first':
-        PostgresHook.get_first = s3_pg_get_first
-        PostgresHook.get_records = s3_pg_get_records
-        PostgresHook.run = s3_pg_run
+class _PooledConnection(object):
+    """ A pooled connection, which is returned to its pool instead of being closed """
 
-    # Execute with the specially patched PostgresHook
+    def __init__(self, pool, key, connection):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_connection', connection)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._connection.__exit__(*exc_info)
+
+    def close(self):
+        connection = self._connection
+        if connection is not None:
+            object.__setattr__(self, '_connection', None)
+            self._pool.release(self._key, connection)
+
+
+def _close_quietly(connection):
     try:
-        return_value = old_s3_rs_execute(self, context)
-    except:
-        raise
+        connection.close()
+    except Exception:
+        pass
+
+
+def _pool_key(hook):
+    """ The pool key of a hook's connections. A hook's schema overrides the database of its connection, so hooks with
+    the same connection id can connect to different databases.
+    """
+
+    return getattr(hook, hook.conn_name_attr), getattr(hook, 'schema', None)
+
+
+def _connect(hook):
+    """ Opens a new connection with the original get_conn of a hook with pooled connections """
+
+    return hook.get_conn.intermix_original(hook)
+
+
+# The pool for connections made outside of any task scope, created on first use and closed at exit
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ConnectionPool(_connect)
+            atexit.register(_process_pool.close)
+        return _process_pool
+
+
+@contextmanager
+def pooled_connections(factory=None):
+    """ Shares connections between the queries of hooks with pooled connections, such as PostgresHook, on the current
+    thread within the block, closing them at the end of it. Nested blocks share the pool of the outermost one.
+    """
+
+    if getattr(_task_context, 'pool', None) is not None:
+        yield _task_context.pool
+        return
+
+    pool = ConnectionPool(factory or _connect)
+    _task_context.pool = pool
+    try:
+        yield pool
     finally:
-        # Undo the patch but leave the existing one in place
-        if PostgresHook.get_first.__name__ == 's3_pg_get_first':
-            PostgresHook.get_first = pg_get_first
-            PostgresHook.get_records = pg_get_records
-            PostgresHook.run = pg_run
+        _task_context.pool = None
+        pool.close()
+
+
+@contextmanager
+def _task_scope(operator):
+    """ Scopes the attribution, and if enabled the connection pool, of the hook queries made by an operator """
+
+    with operator_scope(operator):
+        if POOL_CONNECTIONS:
+            with pooled_connections():
+                yield
+        else:
+            yield
+
+
+# Monotonic where available, for timing the patched calls
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class MetricsSink(object):
+    """ Receives the measurements of the patched calls: the time spent annotating and executing, in milliseconds,
+    and the rows returned. Tags hold the method, the DAG and task and the call site. This default sink discards
+    them, and the measurements aren't taken at all while it is set.
+    """
+
+    enabled = False
+
+    def timing(self, metric, value, tags):
+        pass
+
+    def histogram(self, metric, value, tags):
+        pass
+
+
+class StatsdMetricsSink(MetricsSink):
+    """ Sends measurements to a StatsD server over UDP, with DogStatsD style tags """
+
+    enabled = True
+
+    def __init__(self, host='localhost', port=8125, prefix='intermix'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, metric, value, metric_type, tags):
+        tags = ','.join('{}:{}'.format(key, re.sub(r'[|,#]', '_', str(tag_value)))
+                        for key, tag_value in sorted(tags.items()))
+        payload = '{}.{}:{}|{}'.format(self.prefix, metric, value, metric_type)
+        if tags:
+            payload = '{}|#{}'.format(payload, tags)
+        try:
+            self._socket.sendto(payload.encode('utf-8'), self.address)
+        except (IOError, OSError):
+            # Metrics are best effort and must never fail a query
+            pass
+
+    def timing(self, metric, value, tags):
+        self._send(metric, round(value, 3), 'ms', tags)
+
+    def histogram(self, metric, value, tags):
+        self._send(metric, value, 'h', tags)
+
+
+class Histogram(object):
+    """ Counts values in buckets with 1-2-5 upper bounds, from 1 up to 5e9 """
+
+    BOUNDS = tuple(mantissa * 10 ** exponent for exponent in range(10) for mantissa in (1, 2, 5))
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the bucket holding the percentile, capped at the maximum value """
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+
+class HistogramMetricsSink(MetricsSink):
+    """ Keeps a Histogram in process for each metric and set of tags """
+
+    enabled = True
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, metric, value, tags):
+        key = (metric, tuple(sorted(tags.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(value)
+
+    timing = histogram
+
+    def get(self, metric, **tags):
+        """ Returns the histogram of a metric with exactly the given tags, if any values were recorded """
+
+        return self.histograms.get((metric, tuple(sorted(tags.items()))))
+
+
+def _env_metrics_sink():
+    """ Creates the metrics sink configured in the environment """
+
+    host = os.environ.get('INTERMIX_STATSD_HOST')
+    if host:
+        return StatsdMetricsSink(host, int(os.environ.get('INTERMIX_STATSD_PORT', 8125)),
+                                 os.environ.get('INTERMIX_STATSD_PREFIX', 'intermix'))
+    return MetricsSink()
+
+
+_metrics_sink = _env_metrics_sink()
+
+
+def set_metrics_sink(sink):
+    """ Sets the MetricsSink the patched calls are measured into, None restores the default no-op sink """
+
+    global _metrics_sink
+    _metrics_sink = sink or MetricsSink()
+
+
+def _metric_tags(method, inspected, _self=None):
+    """ Tags a measurement with the same DAG, task and call-site fields as the blob """
+
+    the_file, the_module, the_class, the_function, the_linenumber = inspected
+    tags = {'method': method, 'file': the_file, 'function': the_function, 'linenumber': the_linenumber}
+    if _self:
+        tags.update({'dag': getattr(_self, 'dag_id', None), 'task': getattr(_self, 'task_id', None)})
+    return dict((key, value) for key, value in tags.items() if value)
+
+
+# How the rows returned by each measured method are counted
+_ROW_COUNTS = {'get_records': lambda rows: len(rows or ()), 'get_first': lambda row: 0 if row is None else 1}
+
+
+class QueryJournal(object):
+    """ Receives the statements annotated by the patched calls, with the wall clock time the call started at in epoch
+    milliseconds, the time spent annotating and executing in milliseconds and whether the call raised. This default
+    journal discards them, and the timings aren't taken for it at all.
+    """
+
+    enabled = False
+
+    def record(self, method, statements, started_at, annotation_ms, duration_ms, failed):
+        pass
+
+    def close(self):
+        pass
+
+
+# The columns of the journal table, see SqliteQueryJournal
+JOURNAL_COLUMNS = ('started_at', 'method', 'statement_index', 'annotation_ms', 'duration_ms', 'failed', 'fingerprint',
+                   'annotation', 'fields')
+
+# The fields of the decoded annotations exported with each journal entry
+JOURNAL_FIELDS = ('at', 'dag', 'task', 'owner', 'run_as_user', 'pool', 'queue', 'file', 'module', 'classname',
+                  'function', 'linenumber', 'plugin_ver', 'app_ver')
+
+_JOURNAL_STOP = object()
+
+
+class SqliteQueryJournal(QueryJournal):
+    """ Appends the annotated statements to a SQLite database at `path`, which can be shared by several processes.
+    The patched calls only queue the annotations and the heads of the statements; a background thread decodes the
+    annotations and writes them in batches of up to `batch_size`. When `max_queue` calls are waiting, further ones
+    are dropped and counted rather than blocking the queries.
+    """
+
+    enabled = True
+
+    def __init__(self, path, max_queue=10000, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = Queue(max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._write, name='intermix-journal')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, method, statements, started_at, annotation_ms, duration_ms, failed):
+        # Only the annotation and the head of each statement that is fingerprinted are queued, so the queued calls
+        # don't hold on to whole statements of up to megabytes each
+        heads = []
+        for index, statement in enumerate(statements):
+            match = match_annotation(statement)
+            if match:
+                start = _statement_start(statement, match)
+                heads.append((index, match.groups()[0], statement[start:start + FINGERPRINT_LIMIT]))
+        if not heads:
+            return
+        try:
+            self._queue.put_nowait((method, heads, started_at, annotation_ms, duration_ms, failed))
+        except Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        """ Writes the queued entries and stops the background thread, waiting up to `timeout` seconds """
+
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(_JOURNAL_STOP, timeout=timeout)
+        except Full:
+            return
+        self._thread.join(timeout)
+
+    def _rows(self, entry):
+        method, heads, started_at, annotation_ms, duration_ms, failed = entry
+        for index, annotation, head in heads:
+            fields = decode_annotation(annotation)
+            # Statements sent with the sampled marker have nothing to attribute them to
+            if fields:
+                yield (started_at, method, index, annotation_ms, duration_ms, int(failed),
+                       fields.get('fingerprint') or fingerprint(head),
+                       annotation.strip(), json.dumps(fields))
+
+    def _write(self):
+        # Imported here to keep it out of the import time of the plugin when there's no journal
+        import sqlite3
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS queries ({})'.format(', '.join(JOURNAL_COLUMNS)))
+            insert = 'INSERT INTO queries VALUES ({})'.format(', '.join('?' * len(JOURNAL_COLUMNS)))
+            stopped = False
+            while not stopped:
+                entries = [self._queue.get()]
+                while len(entries) < self.batch_size:
+                    try:
+                        entries.append(self._queue.get_nowait())
+                    except Empty:
+                        break
+                rows = []
+                for entry in entries:
+                    if entry is _JOURNAL_STOP:
+                        stopped = True
+                        continue
+                    try:
+                        rows.extend(self._rows(entry))
+                    except Exception:
+                        traceback.print_exc()
+                try:
+                    with connection:
+                        connection.executemany(insert, rows)
+                except Exception:
+                    # A failed batch is lost, but the journal keeps writing the following ones
+                    traceback.print_exc()
+        finally:
+            connection.close()
+
+
+def _env_journal():
+    """ Creates the query journal configured in the environment """
+
+    path = os.environ.get('INTERMIX_JOURNAL')
+    if path:
+        return SqliteQueryJournal(path, int(os.environ.get('INTERMIX_JOURNAL_QUEUE_SIZE', 10000)))
+    return QueryJournal()
+
+
+_journal = QueryJournal() if _REPLACED else _env_journal()
+
+
+def set_journal(journal):
+    """ Sets the QueryJournal the annotated statements are recorded into, None restores the default no-op journal """
+
+    global _journal
+    _journal = journal or QueryJournal()
+
+
+def _annotated(sql, new_sql):
+    """ Returns the statements of `new_sql` that were annotated from `sql`, which are new strings """
+
+    if isinstance(sql, basestring):
+        return [new_sql] if new_sql is not sql else []
+    return [_sql for old_sql, _sql in zip(sql, new_sql) if _sql is not old_sql]
+
+
+def read_journal(path, since=None):
+    """ Yields the entries of a SQLite query journal as dictionaries, with the decoded annotation fields in place of
+    the fields column, oldest first. `since` is a datetime in UTC.
+    """
+
+    import sqlite3
+
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        query = 'SELECT {} FROM queries'.format(', '.join(JOURNAL_COLUMNS))
+        parameters = ()
+        if since is not None:
+            query += ' WHERE started_at >= ?'
+            parameters = (int((since - _EPOCH).total_seconds() * 1000),)
+        for row in connection.execute(query + ' ORDER BY started_at', parameters):
+            entry = dict(zip(JOURNAL_COLUMNS, row))
+            entry.update(json.loads(entry.pop('fields')))
+            entry['started_at'] = (_EPOCH + timedelta(milliseconds=entry['started_at'])).isoformat() + 'Z'
+            yield entry
+    finally:
+        connection.close()
+
+
+class SlowCallRecorder(object):
+    """ Receives the patched calls that took `threshold` seconds or more, with the time split between annotating,
+    connecting and executing, in milliseconds. This default recorder has no threshold and records nothing, and the
+    connection time isn't measured for it.
+    """
+
+    enabled = False
+    threshold = None
+
+    def start(self):
+        """ Called as a measured call starts, returning a token for its end """
+
+        return None
+
+    def record(self, token, method, inspected, _self, started_at, timings, failed):
+        pass
+
+
+# The frames of a sampled stack, innermost first, and the stacks of a profile kept in a slow call record
+PROFILE_STACK_DEPTH = 30
+PROFILE_TOP_STACKS = 20
+
+
+class DirectorySlowCallRecorder(SlowCallRecorder):
+    """ Writes a JSON diagnostic record of each call that took `threshold` seconds or more to `directory`. With
+    `profile`, a background thread samples the stack of the thread making a call every `interval` seconds once it has
+    run for `threshold` seconds, and the record includes the most frequent stacks.
+    """
+
+    enabled = True
+
+    def __init__(self, directory, threshold, profile=False, interval=0.01):
+        self.directory = directory
+        self.threshold = threshold
+        self.profile = profile
+        self.interval = interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def start(self):
+        if not self.profile:
+            return None
+        token = object()
+        with self._lock:
+            self._calls[token] = (threading.current_thread().ident, _timer(), {})
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='intermix-profiler')
+                self._sampler.daemon = True
+                self._sampler.start()
+        return token
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            sampled_before = _timer() - self.threshold
+            with self._lock:
+                if not self._calls:
+                    # Started again by the next profiled call
+                    self._sampler = None
+                    return
+                calls = [call for call in self._calls.values() if call[1] <= sampled_before]
+            if not calls:
+                continue
+            frames = sys._current_frames()
+            for thread_id, called, samples in calls:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < PROFILE_STACK_DEPTH:
+                    stack.append('{}:{} {}'.format(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+                    frame = frame.f_back
+                if stack:
+                    stack = tuple(stack)
+                    samples[stack] = samples.get(stack, 0) + 1
+            del frames
+
+    def record(self, token, method, inspected, _self, started_at, timings, failed):
+        samples = None
+        if token is not None:
+            with self._lock:
+                samples = self._calls.pop(token)[2]
+        if timings['duration_ms'] < self.threshold * 1000:
+            return
+
+        the_file, the_module, the_class, the_function, the_linenumber = inspected
+        diagnostic = {'method': method, 'started_at': started_at, 'failed': failed, 'pid': os.getpid(),
+                      'host': socket.gethostname(), 'threshold_ms': self.threshold * 1000,
+                      'call_site': {'file': the_file, 'module': the_module, 'classname': the_class,
+                                    'function': the_function, 'linenumber': the_linenumber},
+                      'dag': getattr(_self, 'dag_id', None), 'task': getattr(_self, 'task_id', None)}
+        diagnostic.update(timings)
+        if samples is not None:
+            stacks = sorted(samples.items(), key=lambda item: -item[1])[:PROFILE_TOP_STACKS]
+            diagnostic['profile'] = {'interval_ms': self.interval * 1000, 'samples': sum(samples.values()),
+                                     'stacks': [{'count': count, 'stack': list(stack)} for stack, count in stacks]}
+
+        path = os.path.join(self.directory, 'slow-{}-{}-{}.json'.format(started_at, os.getpid(), uuid.uuid4().hex[:8]))
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        with open(path, 'w') as record_file:
+            json.dump(diagnostic, record_file, indent=2, sort_keys=True)
+
+
+def _env_slow_call_recorder():
+    """ Creates the slow call recorder configured in the environment """
+
+    threshold = float(os.environ.get('INTERMIX_SLOW_THRESHOLD', 0))
+    if threshold > 0:
+        default_directory = os.path.join(os.environ.get('AIRFLOW_HOME', os.path.expanduser('~/airflow')),
+                                         'intermix_slow_calls')
+        return DirectorySlowCallRecorder(os.environ.get('INTERMIX_SLOW_DIRECTORY', default_directory), threshold,
+                                         _env_flag('INTERMIX_SLOW_PROFILE'),
+                                         float(os.environ.get('INTERMIX_SLOW_PROFILE_INTERVAL', 10)) / 1000)
+    return SlowCallRecorder()
+
+
+_slow_call_recorder = _env_slow_call_recorder()
+
+
+def set_slow_call_recorder(recorder):
+    """ Sets the SlowCallRecorder of the patched calls, None restores the default recorder that records nothing """
+
+    global _slow_call_recorder
+    _slow_call_recorder = recorder or SlowCallRecorder()
+
+
+def _connect_time():
+    """ The time spent in the get_conn methods of hooks with pooled connections on the current thread so far """
+
+    return getattr(_task_context, 'connect_time', 0.0)
+
+
+def _measure(method, inspected, _self, started, statements, func, *args, **kwargs):
+    """ Calls `func`, recording the annotation time since `started`, the duration of the call and the rows it
+    returned into the metrics sink, the `statements` it annotated into the query journal and the call into the slow
+    call recorder if it was slow.
+    """
+
+    sink = _metrics_sink
+    journal = _journal
+    recorder = _slow_call_recorder
+    if not sink.enabled and not (statements and journal.enabled) and not recorder.enabled:
+        return func(*args, **kwargs)
+
+    called = _timer()
+    started_at = int(time.time() * 1000)
+    annotation_ms = (called - started) * 1000
+    tags = None
+    if sink.enabled:
+        tags = _metric_tags(method, inspected, _self)
+        try:
+            sink.timing('annotation.duration', annotation_ms, tags)
+        except Exception:
+            traceback.print_exc()
+    token = recorder.start() if recorder.enabled else None
+    connected = _connect_time()
+
+    failed = True
+    try:
+        result = func(*args, **kwargs)
+        failed = False
+    finally:
+        duration_ms = (_timer() - called) * 1000
+        try:
+            if statements and journal.enabled:
+                journal.record(method, statements, started_at, annotation_ms, duration_ms, failed)
+            if recorder.enabled:
+                connect_ms = (_connect_time() - connected) * 1000
+                recorder.record(token, method, inspected, _self, started_at,
+                                {'annotation_ms': annotation_ms, 'connect_ms': connect_ms, 'duration_ms': duration_ms,
+                                 'execution_ms': duration_ms - connect_ms}, failed)
+        except Exception:
+            # If anything raises an exception, we still want it to continue executing as normal
+            traceback.print_exc()
+
+    try:
+        if tags is not None:
+            sink.timing('query.duration', duration_ms, tags)
+            if method in _ROW_COUNTS:
+                sink.histogram('query.rows', _ROW_COUNTS[method](result), tags)
+    except Exception:
+        # If anything raises an exception, we still want it to continue executing as normal
+        traceback.print_exc()
+    return result
+
+
+# Collect the rows loaded, the duration and the query id of each COPY run by the operators registered with
+#   copy_telemetry, such as S3ToRedshiftOperator. This runs a query on the connection of the load after every COPY
+#   with functions only Redshift has.
+COPY_TELEMETRY = _env_flag('INTERMIX_COPY_TELEMETRY')
+COPY_LOADS_XCOM_KEY = 'intermix_copy_loads'
+LAST_COPY_QUERY = 'select pg_last_copy_count(), pg_last_copy_id()'
+
+# The comments, such as the annotation, at the head of a statement
+_LEADING_COMMENTS = r'\s*(?:/\*.*?\*/\s*)*'
+
+# A COPY statement and the table it loads
+_COPY_RE = re.compile(_LEADING_COMMENTS + r'copy\s+([^\s(]+)', re.IGNORECASE | re.DOTALL | re.UNICODE)
+
+
+class _CopyTelemetryConnection(object):
+    """ A connection whose cursors record the COPY statements they execute into `loads` """
+
+    def __init__(self, connection, loads):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_loads', loads)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._connection.__exit__(*exc_info)
+
+    def cursor(self, *args, **kwargs):
+        return _CopyTelemetryCursor(self._connection.cursor(*args, **kwargs), self._loads)
+
+
+class _CopyTelemetryCursor(object):
+    """ A cursor that queries the row count and query id of each COPY it executes on the same connection """
+
+    def __init__(self, cursor, loads):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_loads', loads)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def execute(self, sql, *args, **kwargs):
+        copy = _COPY_RE.match(sql) if isinstance(sql, basestring) else None
+        if copy is None:
+            return self._cursor.execute(sql, *args, **kwargs)
+
+        started = _timer()
+        result = self._cursor.execute(sql, *args, **kwargs)
+        load = {'table': copy.groups()[0], 'duration_ms': (_timer() - started) * 1000, 'rows': None, 'query_id': None}
+        try:
+            self._cursor.execute(LAST_COPY_QUERY)
+            load['rows'], load['query_id'] = self._cursor.fetchone()
+        except Exception:
+            # The load itself succeeded, so it is recorded without them
+            traceback.print_exc()
+        self._loads.append(load)
+        return result
+
+
+def _report_copy_loads(operator, context, inspected, loads):
+    """ Pushes the COPY loads of an operator to XCom under COPY_LOADS_XCOM_KEY and records them into the metrics sink
+    as copy.duration timings and copy.rows histograms
+    """
+
+    try:
+        task_instance = (context or {}).get('ti') or (context or {}).get('task_instance')
+        if task_instance is not None and loads:
+            task_instance.xcom_push(key=COPY_LOADS_XCOM_KEY, value=loads)
+        sink = _metrics_sink
+        if sink.enabled and loads:
+            tags = _metric_tags('copy', inspected, operator)
+            for load in loads:
+                sink.timing('copy.duration', load['duration_ms'], tags)
+                if load['rows'] is not None:
+                    sink.histogram('copy.rows', load['rows'], tags)
+    except Exception:
+        # If anything raises an exception, we still want it to continue executing as normal
+        traceback.print_exc()
+
+
+@contextmanager
+def _copy_telemetry_scope():
+    """ Collects the COPY loads run through hooks with pooled connections on the current thread within the block """
+
+    previous = getattr(_task_context, 'copy_loads', None)
+    loads = _task_context.copy_loads = []
+    try:
+        yield loads
+    finally:
+        _task_context.copy_loads = previous
+
+
+# Annotate each statement of a multi-statement operator script with its ordinal position, rather than only the first
+SPLIT_SCRIPTS = _env_flag('INTERMIX_SPLIT_SCRIPTS')
+
+# The tokens a script is scanned for: statement ends, quotes, comments and dollar quotes
+_SCRIPT_TOKEN_RE = re.compile(r"""[;'"]|--|/\*|\$(?:[^\W\d]\w*)?\$""", re.UNICODE)
+_BLOCK_COMMENT_RE = re.compile(r'/\*|\*/')
+_NON_SPACE_RE = re.compile(r'\S', re.UNICODE)
+_WORD_RE = re.compile(r'\w', re.UNICODE)
+_LEADING_SPACE_RE = re.compile(r'\s*', re.UNICODE)
+
+
+def _quote_end(script, position, quote, backslash_escapes=False):
+    """ Returns the position after the quote that closes a string or identifier opened before `position` """
+
+    while True:
+        closing = script.find(quote, position)
+        if closing < 0:
+            return len(script)
+        if backslash_escapes:
+            escapes = closing
+            while escapes > position and script[escapes - 1] == '\\':
+                escapes -= 1
+            if (closing - escapes) % 2:
+                position = closing + 1
+                continue
+        if script.startswith(quote, closing + 1):
+            # A doubled quote
+            position = closing + 2
+            continue
+        return closing + 1
+
+
+def _block_comment_end(script, position):
+    """ Returns the position after the end of a block comment opened before `position`, which may be nested """
+
+    depth = 1
+    while depth:
+        token = _BLOCK_COMMENT_RE.search(script, position)
+        if token is None:
+            return len(script)
+        depth += 1 if token.group() == '/*' else -1
+        position = token.end()
+    return position
+
+
+def _scan_script(script):
+    """ Scans a script once from token to token, in time linear in its length. Returns the offsets after the
+    semicolons that end its statements, and whether a statement follows the last of them. Semicolons in strings,
+    quoted identifiers, comments and dollar-quoted strings don't end a statement, nor do those of empty statements. As
+    in Redshift, a backslash escapes a quote in any string.
+    """
+
+    ends = []
+    length = len(script)
+    position = 0
+    content = False
+    while position < length:
+        token = _SCRIPT_TOKEN_RE.search(script, position)
+        end = length if token is None else token.start()
+        if not content and _NON_SPACE_RE.search(script, position, end):
+            content = True
+        if token is None:
+            break
+
+        text = token.group()
+        position = token.end()
+        if text == ';':
+            # Empty statements stay with the next one
+            if content:
+                ends.append(position)
+                content = False
+        elif text == '--':
+            newline = script.find('\n', position)
+            position = length if newline < 0 else newline + 1
+        elif text == '/*':
+            position = _block_comment_end(script, position)
+        else:
+            content = True
+            if text == "'":
+                # Redshift allows backslash escapes in all strings, not only in E'...' ones
+                position = _quote_end(script, position, text, backslash_escapes=True)
+            elif text == '"':
+                position = _quote_end(script, position, text)
+            elif end == 0 or not _WORD_RE.match(script, end - 1):
+                # A dollar quote, unless it is part of an identifier
+                closing = script.find(text, position)
+                position = length if closing < 0 else closing + len(text)
+            else:
+                position = end + 1
+    return ends, content
+
+
+def split_statements(script):
+    """ Splits a script into its statements, each with the whitespace and comments before it and its semicolon, so
+    they join back into the script. Trailing whitespace and comments stay with the last statement. See _scan_script()
+    for what ends a statement.
+    """
+
+    if not script:
+        return []
+    ends, trailing = _scan_script(script)
+    if trailing or not ends:
+        ends.append(len(script))
+    else:
+        ends[-1] = len(script)
+    return [script[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+def _is_script(sql):
+    """ Whether anything but whitespace follows the first semicolon of `sql`, which only a script can have """
+
+    semicolon = sql.find(';')
+    return semicolon >= 0 and _NON_SPACE_RE.search(sql, semicolon + 1) is not None
+
+
+def _annotate_script(self, script, inspected):
+    """ Prepends a metadata blob with its ordinal position to each statement of an operator's script, replacing the
+    annotations of a previous try. Returns the annotated script and its statements, or None if it has only one.
+    """
+
+    statements = split_statements(script)
+    if len(statements) < 2:
+        return None
+
+    heads = [_LEADING_SPACE_RE.match(statement).end() for statement in statements]
+    priors = [match_annotation(statement) for statement in statements]
+    # Where each statement resumes after its prior annotation and the space that followed it
+    rests = []
+    for statement, head, prior in zip(statements, heads, priors):
+        rests.append(_statement_start(statement, prior) if prior else head)
+    sampled_out = not any(priors) and not sample_annotation(inspected, self)
+    fingerprinted = None
+    if FINGERPRINT_STATEMENTS:
+        fingerprinted = [statement[rest:] for statement, rest in zip(statements, rests)]
+
+    built = []
+
+    def build(drop):
+        blobs = []
+        batch = None
+        for index, prior in enumerate(priors):
+            if sampled_out:
+                blobs.append(SAMPLED_ANNOTATION)
+            elif prior:
+                blobs.append(annotator(inspected, self, prior, fingerprinted[index] if fingerprinted else None, drop))
+            else:
+                if batch is None:
+                    batch = batch_annotator(inspected, len(statements), self, fingerprinted, drop)
+                blobs.append(batch[index])
+        # The blobs that fit are the last ones built
+        built[:] = blobs
+        return ''.join(blobs)
+
+    # Redshift has a 16MB query length limit, so scripts near it get smaller annotations or none
+    prior_length = sum(rest - head for head, rest in zip(heads, rests))
+    if _size_budget.fit(script, build, prior_length) is None:
+        built[:] = [''] * len(statements)
+    annotated = ['{}{}{}'.format(statement[:head], blob, statement[rest:])
+                 for statement, head, rest, blob in zip(statements, heads, rests, built)]
+    return ''.join(annotated), annotated
+
+
+def _annotate_operator_sql(self, sql_attribute, inspected):
+    """ Prepends a metadata blob as a comment to the statement in an operator attribute, replacing the annotation of a
+    previous try, and returns the annotated statements. With SPLIT_SCRIPTS, each statement of a script is annotated.
+    Lists of statements are left to the hook to annotate.
+    """
+
+    sql = getattr(self, sql_attribute, None)
+    if not isinstance(sql, basestring):
+        return None
+
+    try:
+        if SPLIT_SCRIPTS and _is_script(sql):
+            script = _annotate_script(self, sql, inspected)
+            if script is not None:
+                setattr(self, sql_attribute, script[0])
+                return script[1]
+
+        prior_annotation = match_annotation(sql)
+        sampled_out = prior_annotation is None and not sample_annotation(inspected, self)
+        statement = sql
+        if prior_annotation and FINGERPRINT_STATEMENTS:
+            statement = sql[_statement_start(sql, prior_annotation):]
+
+        def build(drop):
+            if sampled_out:
+                return SAMPLED_ANNOTATION
+            return annotator(inspected, self, prior_annotation, statement, drop)
+        prior_length = prior_annotation.end() if prior_annotation else 0
+        # Redshift has a 16MB query length limit, so statements near it get a smaller annotation or none
+        blob = _size_budget.fit(sql, build, prior_length)
+        if blob is not None:
+            if prior_annotation:
+                # The prior annotation is at the head, so this replaces it with a single copy of the statement
+                sql = sql.replace(prior_annotation.groups()[0], blob, 1)
+            else:
+                sql = '{}{}'.format(blob, sql)
+        elif prior_annotation:
+            sql = sql[prior_length:]
+        setattr(self, sql_attribute, sql)
+        return [sql]
+    except:
+        # If anything raises an exception, we still want it to continue executing as normal
+        traceback.print_exc()
+    return None
+
+
+def _native_name(name):
+    """ Function names are byte strings on Python 2 """
+
+    return name if isinstance(name, type(str.__name__)) else name.encode()
+
+
+def _operator_wrapper(original, name, sql_attribute, copy_telemetry=False, measure=True):
+    """ Creates an operator's execute method that annotates the statement in its `sql_attribute`, if any, and
+    attributes the hook queries made while it executes to the operator. With `copy_telemetry`, the COPY loads it runs
+    are reported, see _report_copy_loads(). Without `measure`, the execute call itself isn't measured, only the hook
+    queries it makes.
+    """
+
+    def wrapper(self, context):
+        if not measure:
+            with _task_scope(self):
+                return original(self, context)
+
+        started = _timer()
+        inspected = inspector()
+        statements = _annotate_operator_sql(self, sql_attribute, inspected) if sql_attribute else None
+        with _task_scope(self):
+            if not copy_telemetry:
+                return _measure('execute', inspected, self, started, statements, original, self, context)
+            with _copy_telemetry_scope() as loads:
+                result = _measure('execute', inspected, self, started, statements, original, self, context)
+            _report_copy_loads(self, context, inspected, loads)
+            return result
+
+    wrapper.__name__ = _native_name(name)
+    wrapper.__doc__ = original.__doc__
+    wrapper.intermix_original = original
+    return wrapper
+
+
+# Run the statement lists of the patched run methods in as few multi-statement round trips as fit in
+#   BATCH_PAYLOAD_LIMIT UTF-8 bytes, rather than one round trip per statement
+BATCH_STATEMENTS = _env_flag('INTERMIX_BATCH_STATEMENTS')
+BATCH_PAYLOAD_LIMIT = QUERY_BYTE_LIMIT
+
+# Statements that can't run inside the implicit transaction of a multi-statement query
+_UNBATCHABLE_RE = re.compile(_LEADING_COMMENTS + r'(?:vacuum|(?:create|drop)\s+database|alter\s+table\s+\S+\s+append)'
+                             r'\b', re.IGNORECASE | re.DOTALL | re.UNICODE)
+
+
+def _terminated(statement):
+    """ Ends a statement with a semicolon on its own line, so a trailing line comment can't swallow it, unless a
+    semicolon outside of its strings and comments already ends it
+    """
+
+    ends, trailing = _scan_script(statement)
+    if ends and not trailing:
+        return statement
+    return '{}\n;'.format(statement)
+
+
+def _batches(statements, limit=None, alone=_UNBATCHABLE_RE.match):
+    """ Groups consecutive statements into multi-statement payloads of up to `limit` UTF-8 bytes. Statements that are
+    longer than that on their own, or that `alone` matches, get a payload to themselves. Yields the payloads with
+    the range of statements in each.
+    """
+
+    limit = BATCH_PAYLOAD_LIMIT if limit is None else limit
+    batch = []
+    size = start = 0
+    for index, statement in enumerate(statements):
+        statement = _terminated(statement)
+        length = utf8_length(statement, limit)
+        by_itself = length >= limit or alone(statement)
+        if batch and (by_itself or size + length + 1 > limit):
+            yield '\n'.join(batch), start, index
+            batch = []
+            size = 0
+        if by_itself:
+            yield statement, index, index + 1
+            continue
+        if not batch:
+            start = index
+        batch.append(statement)
+        size += length + 1
+    if batch:
+        yield '\n'.join(batch), start, len(statements)
+
+
+def _unbatchable_with_telemetry(statement):
+    """ Each COPY is followed by its own telemetry query, see _CopyTelemetryCursor """
+
+    return _UNBATCHABLE_RE.match(statement) or _COPY_RE.match(statement)
+
+
+def _run_arguments(autocommit=False, parameters=None):
+    """ Binds the arguments of DbApiHook.run that _run_batched() handles, raising TypeError for any others """
+
+    return autocommit, parameters
+
+
+def _run_batched(original, hook, sql, *args, **kwargs):
+    """ Runs a list of statements like DbApiHook.run, in multi-statement payloads. Statements keep their own
+    annotations. When a payload fails, its statements are executed again one at a time, along with the ones before it
+    in the same transaction, so the error raised is that of the statement that failed. Calls with arguments other
+    than `autocommit` and `parameters`, such as a `handler`, are left to the original run.
+    """
+
+    try:
+        autocommit, parameters = _run_arguments(*args, **kwargs)
+    except TypeError:
+        return original(hook, sql, *args, **kwargs)
+    if isinstance(sql, basestring) or len(sql) < 2 or parameters is not None:
+        return original(hook, sql, *args, **kwargs)
+
+    alone = _UNBATCHABLE_RE.match
+    if getattr(_task_context, 'copy_loads', None) is not None:
+        alone = _unbatchable_with_telemetry
+
+    with closing(hook.get_conn()) as conn:
+        if hook.supports_autocommit:
+            hook.set_autocommit(conn, autocommit)
+        autocommit = autocommit and hook.supports_autocommit
+        with closing(conn.cursor()) as cur:
+            # The first statement of the current transaction
+            committed = 0
+            for payload, start, end in _batches(sql, alone=alone):
+                try:
+                    cur.execute(payload)
+                except Exception:
+                    if end - start == 1:
+                        raise
+                    # Nothing of the transaction is left, so it is replayed statement by statement
+                    conn.rollback()
+                    for statement in sql[committed:end]:
+                        cur.execute(statement)
+                if autocommit:
+                    committed = end
+        conn.commit()
+
+
+def _hook_wrapper(original, name, method, batch=False):
+    """ Creates a hook query method that prepends a metadata blob as a comment to the front of each statement before
+    it is executed. With `batch` and BATCH_STATEMENTS, run executes statement lists in multi-statement payloads.
+    """
+
+    def wrapper(self, sql, *args, **kwargs):
+        started = _timer()
+        inspected = inspector()
+        operator = active_operator()
+        if not isinstance(sql, (basestring, list, tuple)):
+            # Iterators can only be read once, so they are read into a list for annotating and the journal
+            sql = list(sql)
+        new_sql = _annotate_statements(sql, inspected, operator)
+        statements = _annotated(sql, new_sql) if _journal.enabled else None
+        if method == 'run' and batch and BATCH_STATEMENTS:
+            return _measure(method, inspected, operator, started, statements, _run_batched, original, self, new_sql,
+                            *args, **kwargs)
+        return _measure(method, inspected, operator, started, statements, original, self, new_sql, *args, **kwargs)
+
+    wrapper.__name__ = _native_name(name)
+    wrapper.__doc__ = original.__doc__
+    wrapper.intermix_original = original
+    return wrapper
+
+
+def _get_conn_wrapper(original, name):
+    """ Creates a hook get_conn method that returns a pooled connection within pooled_connections(), or when pooling is
+    enabled for the process. Within _copy_telemetry_scope() the connection records the COPY loads run on it. The
+    time spent connecting is measured for the slow call recorder.
+    """
+
+    def wrapper(self):
+        connecting = _timer() if _slow_call_recorder.enabled else None
+        pool = getattr(_task_context, 'pool', None)
+        if pool is not None:
+            connection = pool.acquire(_pool_key(self), self)
+        elif POOL_CONNECTIONS:
+            connection = _get_process_pool().acquire(_pool_key(self), self)
+        else:
+            connection = original(self)
+        if connecting is not None:
+            _task_context.connect_time = _connect_time() + _timer() - connecting
+        loads = getattr(_task_context, 'copy_loads', None)
+        if loads is not None:
+            return _CopyTelemetryConnection(connection, loads)
+        return connection
+
+    wrapper.__name__ = _native_name(name)
+    wrapper.__doc__ = original.__doc__
+    wrapper.intermix_original = original
+    return wrapper
+
+
+# Rows fetched per round trip by PostgresHook.iter_records()
+STREAM_BATCH_SIZE = int(os.environ.get('INTERMIX_STREAM_BATCH_SIZE', 10000))
+
+
+def _stream_records(hook, sql, parameters, batch_size):
+    conn = hook.get_conn()
+    try:
+        # A named cursor is declared on the server, so rows are only transferred as they are fetched
+        cur = conn.cursor(name='intermix_{}'.format(uuid.uuid4().hex))
+        try:
+            cur.itersize = batch_size
+            if parameters is not None:
+                cur.execute(sql, parameters)
+            else:
+                cur.execute(sql)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+
+def _iter_records_wrapper(name):
+    """ Creates a hook iter_records method, see _stream_records() """
+
+    def wrapper(self, sql, parameters=None, batch_size=None):
+        """ Appends a metadata blob as a comment to the front of the query and returns an iterator over its records.
+        The records are fetched `batch_size` at a time from a server-side cursor, so only one batch is held in memory.
+        """
+        new_sql = _annotate_statements(sql, inspector(), active_operator())
+        return _stream_records(self, new_sql, parameters, batch_size or STREAM_BATCH_SIZE)
+
+    wrapper.__name__ = _native_name(name)
+    wrapper.intermix_original = None
+    return wrapper
+
+
+def _is_wrapper(attribute):
+    return hasattr(attribute, 'intermix_original')
+
+
+# The query methods of DbApiHook, which are annotated on registered hooks by default
+HOOK_METHODS = ('get_first', 'get_records', 'run')
+
+S3_TO_REDSHIFT = 'RedshiftPlugin.operators.s3_to_redshift.S3ToRedshiftOperator'
+
+# Registered hooks and operators that aren't imported yet, by module and class name
+_registry = {}
+# The original attributes of the patched classes, see disable_annotation()
+_patched = {}
+_MISSING = object()
+
+
+def _env_list(name):
+    """ Reads a comma separated setting from the environment """
+
+    return [item.strip() for item in os.environ.get(name, '').split(',') if item.strip()]
+
+
+# Dotted paths of hooks and operators, including the default ones, that are never patched
+DISABLED = set(_env_list('INTERMIX_DISABLED'))
+
+
+def _patch_class(cls, kind, options):
+    """ Patches a registered hook or operator class with the wrappers for its options """
+
+    global PATCH_S3_TO_REDSHIFT
+    if cls in _patched:
+        return
+
+    attributes = {}
+    if kind == 'hook':
+        for method in options['methods']:
+            original = getattr(cls, method, None)
+            # Methods inherited from an annotated hook are already annotated
+            if original is not None and not _is_wrapper(original):
+                attributes[method] = _hook_wrapper(original, '{}_{}'.format(options['prefix'], method), method,
+                                                   options['batch'])
+        if options['pool'] and not _is_wrapper(cls.get_conn):
+            attributes['get_conn'] = _get_conn_wrapper(cls.get_conn, '{}_get_conn'.format(options['prefix']))
+        if options['stream'] and not _is_wrapper(getattr(cls, 'iter_records', None)):
+            attributes['iter_records'] = _iter_records_wrapper('{}_iter_records'.format(options['prefix']))
+    elif not _is_wrapper(cls.execute):
+        attributes['execute'] = _operator_wrapper(cls.execute, options['name'], options['sql_attribute'],
+                                                  options['copy_telemetry'], options['measure'])
+
+    _patched[cls] = dict((attribute, cls.__dict__.get(attribute, _MISSING)) for attribute in attributes)
+    for attribute, wrapper in attributes.items():
+        setattr(cls, attribute, wrapper)
+
+    if '{}.{}'.format(cls.__module__, cls.__name__) == S3_TO_REDSHIFT:
+        PATCH_S3_TO_REDSHIFT = True
+
+
+def _patch_module(module):
+    """ Patches the registered classes of a module once it has been imported """
+
+    for class_name, (kind, options) in list(_registry.get(module.__name__, {}).items()):
+        try:
+            cls = getattr(module, class_name)
+            _patch_class(cls, kind, options)
+        except:
+            # A class that can't be patched is still usable as it is
+            traceback.print_exc()
+
+
+def _register(cls, kind, options):
+    if isinstance(cls, basestring):
+        module_name, class_name = cls.rsplit('.', 1)
+        if cls in DISABLED:
+            return
+        _registry.setdefault(module_name, {})[class_name] = (kind, options)
+        module = sys.modules.get(module_name)
+        if module is not None:
+            _patch_module(module)
+    elif '{}.{}'.format(cls.__module__, cls.__name__) not in DISABLED:
+        _patch_class(cls, kind, options)
+
+
+def register_hook(hook, methods=HOOK_METHODS, prefix='intermix', pool=False, stream=False, batch=False):
+    """ Annotates the statements run through the query `methods` of a DbApiHook subclass, given as the class or its
+    dotted path. Hooks given by path are patched when their module is imported. With `pool`, connections of the hook
+    are pooled like those of PostgresHook. With `stream`, the hook gets an iter_records method, which needs a driver
+    with psycopg2 style server-side cursors. With `batch`, its run method sends statement lists in multi-statement
+    payloads when BATCH_STATEMENTS is set, which needs a driver that accepts them like psycopg2.
+    """
+
+    _register(hook, 'hook', {'methods': tuple(methods), 'prefix': prefix, 'pool': pool, 'stream': stream,
+                             'batch': batch})
+
+
+def register_operator(operator, sql_attribute='sql', name='intermix_execute', copy_telemetry=False, measure=True):
+    """ Annotates the statement in the `sql_attribute` of an operator, given as the class or its dotted path, and
+    attributes the hook queries made while it executes to it. With no `sql_attribute`, only the hook queries are
+    attributed. Operators given by path are patched when their module is imported. With `copy_telemetry`, the rows,
+    duration and query id of each COPY the operator runs on Redshift are pushed to XCom and the metrics sink. Without
+    `measure`, the execute calls of the operator aren't measured themselves, which suits operators like sensors that
+    spend most of their time waiting.
+    """
+
+    _register(operator, 'operator', {'sql_attribute': sql_attribute, 'name': name, 'copy_telemetry': copy_telemetry,
+                                     'measure': measure})
+
+
+def disable_annotation(cls):
+    """ Restores the original methods of a registered hook or operator, given as the class or its dotted path, so
+    calls pass straight through to them.
+    """
+
+    if isinstance(cls, basestring):
+        module_name, class_name = cls.rsplit('.', 1)
+        _registry.get(module_name, {}).pop(class_name, None)
+        cls = getattr(sys.modules.get(module_name), class_name, None)
+
+    for attribute, original in _patched.pop(cls, {}).items():
+        if original is _MISSING:
+            delattr(cls, attribute)
+        else:
+            setattr(cls, attribute, original)
+
+
+class _PatchingLoader(object):
+    """ Wraps the loader of a registered module to patch the module once it has been executed """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        _patch_module(module)
+
+
+class _PatchingFinder(object):
+    """ Import hook that patches the registered modules when they are imported. It only finds the modules through
+    the rest of sys.meta_path, and leaves all other imports alone.
+    """
+
+    intermix_patching_finder = True
+
+    def __init__(self):
+        self._finding = set()
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in _registry or fullname in self._finding:
+            return None
+        self._finding.add(fullname)
+        try:
+            spec = find_spec(fullname)
+        finally:
+            self._finding.discard(fullname)
+        if spec is None or spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return None
+        spec.loader = _PatchingLoader(spec.loader)
+        return spec
+
+    # Python 2 import hook protocol
+    def find_module(self, fullname, path=None):
+        if fullname not in _registry or fullname in self._finding:
+            return None
+        return self
+
+    def load_module(self, fullname):
+        self._finding.add(fullname)
+        try:
+            module = import_module(fullname)
+        finally:
+            self._finding.discard(fullname)
+        _patch_module(module)
+        return module
+
+
+def install():
+    """ Patches the registered modules that are already imported and installs the import hook that patches the
+    others when they are imported.
+    """
+
+    for name in list(_registry):
+        module = sys.modules.get(name)
+        if module is not None:
+            _patch_module(module)
+
+    if not any(getattr(finder, 'intermix_patching_finder', False) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _PatchingFinder())
+
+
+def _register_defaults():
+    """ Registers the hooks and operators annotated by default """
+
+    register_hook('airflow.hooks.postgres_hook.PostgresHook', prefix='pg', pool=True, stream=True, batch=True)
+    register_operator('airflow.operators.postgres_operator.PostgresOperator', name='pg_execute_appended')
+    register_operator(S3_TO_REDSHIFT, sql_attribute=None, name='s3_rs_execute', copy_telemetry=COPY_TELEMETRY)
+    # Sensors poll through hooks without being registered operators, so their queries are attributed to their DAG
+    #   and task, for the sampling policies and annotations, by registering the base sensor of Airflow 1.10 and 1.9
+    register_operator('airflow.sensors.base_sensor_operator.BaseSensorOperator', sql_attribute=None,
+                      name='sensor_execute', measure=False)
+    register_operator('airflow.operators.sensors.BaseSensorOperator', sql_attribute=None, name='sensor_execute',
+                      measure=False)
+
+
+def _register_env():
+    """ Registers the further hooks and operators in the environment, as dotted paths. Operators can be followed by
+    ':' and their sql attribute, or ':' alone to only attribute their hook queries.
+    """
+
+    for path in _env_list('INTERMIX_HOOKS'):
+        register_hook(path)
+    for path in _env_list('INTERMIX_OPERATORS'):
+        path, separator, sql_attribute = path.partition(':')
+        register_operator(path, sql_attribute=sql_attribute if separator else 'sql')
+
+
+if not _REPLACED:
+    _register_defaults()
+    _register_env()
+    install()
+
+
+def main(argv=None):
+    """ Exports a query journal as CSV or JSON lines, for loading into Redshift and joining with STL_QUERY on the
+    annotation at the head of its querytxt. Run with `python intermix.py journal.db`.
+    """
+
+    # Imported here to keep them out of the import time of the plugin
+    import argparse
+    import csv
+
+    parser = argparse.ArgumentParser(description='Exports an intermix query journal')
+    parser.add_argument('journal', help='path of the SQLite query journal')
+    parser.add_argument('--since', help='only export queries started at or after this UTC time, as YYYY-MM-DDTHH:MM:SS')
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv', help='output format (default: csv)')
+    parser.add_argument('--output', help='file to write to instead of standard output')
+    args = parser.parse_args(argv)
+
+    since = datetime.strptime(args.since, '%Y-%m-%dT%H:%M:%S') if args.since else None
+    columns = [column for column in JOURNAL_COLUMNS if column != 'fields'] + list(JOURNAL_FIELDS)
+    # The csv module of Python 2 writes byte strings
+    python2 = sys.version_info[0] == 2
+    output = open(args.output, 'wb' if python2 else 'w') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.writer(output)
+            writer.writerow(columns)
+        for entry in read_journal(args.journal, since):
+            if args.format == 'json':
+                output.write(json.dumps(entry, sort_keys=True) + '\n')
+                continue
+            row = [entry.get(column, '') for column in columns]
+            if python2:
+                row = [value.encode('utf-8') if isinstance(value, str) else value for value in row]
+            writer.writerow(row)
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
 
-    return return_value
 
+if _REPLACED:
+    # Code holding on to this copy rather than the intermix module, such as a plugin manager, gets the functions and
+    #   settings of the intermix module, so setting a sampling policy or metrics sink through it applies everywhere
+    for _name, _value in list(vars(_intermix).items()):
+        if not _name.startswith('__'):
+            globals()[_name] = _value
 
-# Monkey patch with the new execution methods if they haven't already been patched
-if old_pg_execute.__name__ != 'pg_execute_appended':
-    PostgresOperator.execute = pg_execute_appended
-    PostgresHook.get_first = pg_get_first
-    PostgresHook.get_records = pg_get_records
-    PostgresHook.run = pg_run
 
-    if PATCH_S3_TO_REDSHIFT:
-        S3ToRedshiftOperator.execute = s3_rs_execute
+if __name__ == '__main__':
+    sys.exit(main())
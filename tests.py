@@ -3,33 +3,49 @@ from __future__ import unicode_literals
 import base64
 from datetime import datetime
 import json
-from mock import patch
+from mock import MagicMock, PropertyMock, patch
 import os
 import psycopg2
+import re
+import socket
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import warnings
 
-# Import to get S3ToRedshiftOperator patch status
+# Import to patch Airflow and get S3ToRedshiftOperator patch status
 try:
-    from intermix import PATCH_S3_TO_REDSHIFT
+    import intermix
 except ImportError:
     # When this file is loaded by the plugin manager the intermix module won't be on the path so this will throw an
     #   error but doesn't have any side effects as the plugin manager doesn't run tests.
     pass
 
 from airflow import __version__ as AIRFLOW_VERSION
+from airflow.hooks.dbapi_hook import DbApiHook
 from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator
 from airflow.operators.postgres_operator import PostgresOperator
+try:
+    from airflow.sensors.base_sensor_operator import BaseSensorOperator
+except ImportError:
+    from airflow.operators.sensors import BaseSensorOperator
 
 
 class TestPatchedExecute(unittest.TestCase):
 
     def test_is_patched(self):
         self.assertEqual('pg_execute_appended', PostgresOperator.execute.__name__)
+        self.assertEqual('pg_get_conn', PostgresHook.get_conn.__name__)
         self.assertEqual('pg_get_first', PostgresHook.get_first.__name__)
         self.assertEqual('pg_get_records', PostgresHook.get_records.__name__)
         self.assertEqual('pg_run', PostgresHook.run.__name__)
-        if PATCH_S3_TO_REDSHIFT:
+        self.assertEqual('sensor_execute', BaseSensorOperator.execute.__name__)
+        if intermix.PATCH_S3_TO_REDSHIFT:
             this_parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
             sys.path.append(this_parent_path)
             from RedshiftPlugin.operators.s3_to_redshift import S3ToRedshiftOperator
@@ -67,7 +83,7 @@ class TestPatchedExecute(unittest.TestCase):
         del deserialized_blob['at']
         self.assertDictEqual({'plugin': 'intermix-airflow-plugin', 'plugin_ver': '0.4', 'app': 'airflow',
                               'module': '__main__', 'classname': 'TestPatchedExecute', 'file': 'tests.py',
-                              'function': 'test_prepends_blob_in_hook', 'linenumber': '47',
+                              'function': 'test_prepends_blob_in_hook', 'linenumber': '63',
                               'app_ver': str(AIRFLOW_VERSION)}, deserialized_blob)
 
     @patch.object(psycopg2, 'connect')
@@ -95,9 +111,923 @@ class TestPatchedExecute(unittest.TestCase):
         self.assertDictEqual({'queue': 'default', 'task': 'some_task', 'plugin': 'intermix-airflow-plugin',
                               'module': '__main__', 'classname': 'TestPatchedExecute',
                               'file': 'tests.py', 'function': 'test_prepends_blob_in_operator', 'plugin_ver': '0.4',
-                              'app': 'airflow', 'app_ver': str(AIRFLOW_VERSION), 'owner': 'Airflow', 'linenumber': '82',
+                              'app': 'airflow', 'app_ver': str(AIRFLOW_VERSION), 'owner': 'Airflow', 'linenumber': '98',
                               'dag': 'adhoc_Airflow'}, deserialized_blob)
 
+    @patch.object(psycopg2, 'connect')
+    def test_prepends_batch_blobs_in_hook(self, psycopg2_connect):
+        """ Test a list of statements is annotated from a single inspection
+        """
+        execute = psycopg2_connect.return_value.cursor.return_value.execute
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        statements = ['select {};'.format(index) for index in range(5)]
+        with patch.object(intermix, 'inspector', wraps=intermix.inspector) as inspector:
+            hook.run(sql=statements)
+        self.assertEqual(1, inspector.call_count)
+
+        blobs = []
+        for index, call in enumerate(execute.call_args_list):
+            args, kwargs = call
+            prepend, statement = args[0].split(' */ ')
+            self.assertEqual(statements[index], statement)
+            blobs.append(json.loads(base64.b64decode(prepend[16:])))
+
+        for index, blob in enumerate(blobs):
+            self.assertEqual(index, blob.pop('statement_index'))
+            self.assertDictEqual(blobs[0], blob)
+
+    @patch.object(psycopg2, 'connect')
+    def test_annotates_statement_iterators_by_position(self, psycopg2_connect):
+        """ Test statements from an iterator are annotated, with their positions in it as their indexes
+        """
+        execute = psycopg2_connect.return_value.cursor.return_value.execute
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        prior = intermix.annotator(intermix.inspector()) + 'select 0;'
+        hook.run(statement for statement in [prior, 'select 1;', 'select 2;'])
+
+        statements = [args[0] for args, kwargs in execute.call_args_list]
+        self.assertEqual(prior, statements[0])
+        self.assertEqual([None, 1, 2], [intermix.decode_annotation(statement).get('statement_index')
+                                        for statement in statements])
+
+    @patch.object(psycopg2, 'connect')
+    def test_replaces_blob_in_operator(self, psycopg2_connect):
+        """ Test re-executing the PostgresOperator keeps a single, merged annotation
+        """
+        PO = PostgresOperator(sql='select * from users;', task_id='some_task')
+        PO.execute(None)
+        first_sql = PO.sql
+        PO.execute(None)
+        self.assertEqual(1, PO.sql.count('/* INTERMIX_ID: '))
+        self.assertEqual(intermix.decode_annotation(first_sql), intermix.decode_annotation(PO.sql))
+        self.assertEqual('select * from users;', PO.sql[-20:])
+
+    @patch.object(psycopg2, 'connect')
+    @patch('intermix.SPLIT_SCRIPTS', True)
+    def test_annotates_script_statements_in_operator(self, psycopg2_connect):
+        """ Test each statement of an operator script is annotated with its position, once across retries
+        """
+        script = "delete from users where name = 'a;b';\n-- reload;\ninsert into users select * from staging;\n"
+        PO = PostgresOperator(sql=script, task_id='some_task')
+        PO.execute(None)
+        first_sql = PO.sql
+        PO.execute(None)
+        statements = intermix.split_statements(PO.sql)
+        self.assertEqual(2, len(statements))
+        self.assertEqual(2, PO.sql.count('/* INTERMIX_ID: '))
+        self.assertEqual(len(first_sql), len(PO.sql))
+        self.assertEqual(script, re.sub(r'/\* INTERMIX_ID: .*? \*/ ', '', PO.sql))
+        for index, statement in enumerate(statements):
+            blob = intermix.decode_annotation(statement)
+            self.assertEqual((index, 'some_task'), (blob['statement_index'], blob['task']))
+
+    @patch.object(psycopg2, 'connect')
+    def test_streams_records_in_hook(self, psycopg2_connect):
+        """ Test streaming records through a server-side cursor
+        """
+        connection = psycopg2_connect.return_value
+        cursor = connection.cursor.return_value
+        rows = [(index,) for index in range(25)]
+        cursor.fetchmany.side_effect = lambda size: [rows.pop(0) for _ in range(min(size, len(rows)))]
+
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        records = hook.iter_records('select * from events;', batch_size=10)
+        self.assertFalse(cursor.execute.called)
+        self.assertEqual([(index,) for index in range(25)], list(records))
+
+        self.assertEqual(4, cursor.fetchmany.call_count)
+        self.assertTrue(connection.cursor.call_args[1]['name'])
+        args, kwargs = cursor.execute.call_args
+        self.assertEqual('select * from events;', args[0][-21:])
+        self.assertEqual('test_streams_records_in_hook', intermix.decode_annotation(args[0])['function'])
+        cursor.close.assert_called_once_with()
+        connection.close.assert_called_once_with()
+
+
+class TestOperatorScope(unittest.TestCase):
+
+    @patch.object(psycopg2, 'connect')
+    def test_concurrent_attribution(self, psycopg2_connect):
+        """ Test queries from operators executing on concurrent threads are attributed to the right operator
+        """
+        executed = []
+
+        def capture(sql, *args, **kwargs):
+            executed.append((threading.current_thread().name, sql))
+        psycopg2_connect.return_value.cursor.return_value.execute.side_effect = capture
+
+        class LoadOperator(BaseOperator):
+
+            def execute(self, context):
+                hook = PostgresHook(postgres_conn_id='postgres_default')
+                for index in range(25):
+                    hook.get_first('select {};'.format(index))
+                    hook.run('truncate table_{};'.format(index))
+                    time.sleep(0)
+                return self.task_id
+
+        def execute(operator, results):
+            results[operator.task_id] = operator.execute(None)
+
+        intermix.register_operator(LoadOperator, sql_attribute=None)
+        self.addCleanup(intermix.disable_annotation, LoadOperator)
+        results = {}
+        operators = [LoadOperator(task_id='task_{}'.format(index)) for index in range(8)]
+        threads = [threading.Thread(target=execute, name=operator.task_id, args=(operator, results))
+                   for operator in operators]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(dict((operator.task_id, operator.task_id) for operator in operators), results)
+        self.assertEqual(8 * 25 * 2, len(executed))
+        for thread_name, sql in executed:
+            self.assertEqual(thread_name, intermix.decode_annotation(sql)['task'])
+        self.assertEqual('pg_get_first', PostgresHook.get_first.__name__)
+        self.assertIsNone(intermix.active_operator())
+
+
+class TestRegistry(unittest.TestCase):
+
+    class LoadHook(DbApiHook):
+        conn_name_attr = 'load_conn_id'
+
+        def get_conn(self):
+            return psycopg2.connect()
+
+    class LoadOperator(BaseOperator):
+
+        def __init__(self, query, *args, **kwargs):
+            super(TestRegistry.LoadOperator, self).__init__(*args, **kwargs)
+            self.query = query
+
+        def execute(self, context):
+            TestRegistry.LoadHook().run(self.query)
+
+    def tearDown(self):
+        intermix.disable_annotation(self.LoadHook)
+        intermix.disable_annotation(self.LoadOperator)
+
+    @patch.object(psycopg2, 'connect')
+    def test_annotates_registered_classes(self, psycopg2_connect):
+        """ Test any DbApiHook subclass and operator can be registered for annotation
+        """
+        intermix.register_hook(self.LoadHook)
+        intermix.register_operator(self.LoadOperator, sql_attribute='query')
+        self.assertEqual('intermix_run', self.LoadHook.run.__name__)
+        self.assertEqual('intermix_execute', self.LoadOperator.execute.__name__)
+
+        self.LoadOperator(query='select 1;', task_id='load').execute(None)
+        args, kwargs = psycopg2_connect.return_value.cursor.return_value.execute.call_args
+        self.assertEqual(1, args[0].count('INTERMIX_ID'))
+        self.assertEqual('load', intermix.decode_annotation(args[0])['task'])
+        self.assertEqual('test_annotates_registered_classes', intermix.decode_annotation(args[0])['function'])
+
+    @patch.object(psycopg2, 'connect')
+    def test_disabled_classes_pass_through(self, psycopg2_connect):
+        """ Test disabling annotation restores the original methods of a class
+        """
+        run = self.LoadHook.run
+        intermix.register_hook(self.LoadHook)
+        intermix.disable_annotation(self.LoadHook)
+        self.assertIs(run, self.LoadHook.run)
+        self.assertNotIn('run', vars(self.LoadHook))
+
+        self.LoadHook().run('select 1;')
+        args, kwargs = psycopg2_connect.return_value.cursor.return_value.execute.call_args
+        self.assertEqual('select 1;', args[0])
+
+
+class TestCopyTelemetry(unittest.TestCase):
+
+    class StubCursor(object):
+        """ A cursor that answers the telemetry query after a COPY """
+
+        def __init__(self, executed):
+            self.executed = executed
+            self.row = None
+
+        def execute(self, sql, parameters=None):
+            self.executed.append(sql)
+            self.row = (1200, 345) if sql == intermix.LAST_COPY_QUERY else None
+
+        def fetchone(self):
+            return self.row
+
+        def close(self):
+            pass
+
+    class LoadOperator(BaseOperator):
+
+        def execute(self, context):
+            hook = PostgresHook(postgres_conn_id='redshift_default')
+            hook.run(["copy events from 's3://bucket/events' iam_role 'arn'", 'analyze events;',
+                      "COPY public.users (id, name) from 's3://bucket/users' iam_role 'arn'"])
+            return 'loaded'
+
+    def setUp(self):
+        intermix.register_operator(self.LoadOperator, sql_attribute=None, copy_telemetry=True)
+
+    def tearDown(self):
+        intermix.disable_annotation(self.LoadOperator)
+        intermix.set_metrics_sink(None)
+
+    @patch.object(psycopg2, 'connect')
+    def test_reports_copy_loads(self, psycopg2_connect):
+        executed = []
+        psycopg2_connect.return_value.cursor.return_value = self.StubCursor(executed)
+        sink = intermix.HistogramMetricsSink()
+        intermix.set_metrics_sink(sink)
+        task_instance = MagicMock()
+
+        self.assertEqual('loaded', self.LoadOperator(task_id='load').execute({'ti': task_instance}))
+        self.assertEqual([False, True, False, False, True], [sql == intermix.LAST_COPY_QUERY for sql in executed])
+        args, kwargs = task_instance.xcom_push.call_args
+        self.assertEqual(intermix.COPY_LOADS_XCOM_KEY, kwargs['key'])
+        self.assertEqual([('events', 1200, 345), ('public.users', 1200, 345)],
+                         [(load['table'], load['rows'], load['query_id']) for load in kwargs['value']])
+        self.assertEqual([(2, 2400, 'load')], [(histogram.count, histogram.total, dict(tags)['task'])
+                                               for (metric, tags), histogram in sink.histograms.items()
+                                               if metric == 'copy.rows'])
+
+        # Outside of the operator, hook queries aren't followed by the telemetry query
+        del executed[:]
+        PostgresHook(postgres_conn_id='redshift_default').run("copy events from 's3://bucket/events'")
+        self.assertEqual(1, len(executed))
+
+
+@patch('intermix.BATCH_STATEMENTS', True)
+class TestBatchedRun(unittest.TestCase):
+
+    @patch.object(psycopg2, 'connect')
+    def test_runs_statements_in_payloads(self, psycopg2_connect):
+        cursor = psycopg2_connect.return_value.cursor.return_value
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        statements = ['truncate events;', 'insert into events select * from staging -- copy', 'vacuum events;',
+                      'analyze events;', 'select 1;']
+        hook.run(statements)
+
+        payloads = [args[0] for args, kwargs in cursor.execute.call_args_list]
+        self.assertEqual([2, 1, 2], [payload.count('INTERMIX_ID') for payload in payloads])
+        self.assertEqual('vacuum events;', payloads[1][-14:])
+        self.assertTrue(payloads[0].endswith('-- copy\n;'))
+        self.assertEqual(list(range(5)), [intermix.decode_annotation(statement)['statement_index']
+                                          for payload in payloads for statement in payload.split('\n')
+                                          if statement.startswith('/*')])
+        psycopg2_connect.return_value.commit.assert_called_once_with()
+
+        # Statements with parameters aren't batched
+        cursor.execute.reset_mock()
+        hook.run(statements, parameters=(1,))
+        self.assertEqual(5, cursor.execute.call_count)
+
+    @patch.object(psycopg2, 'connect')
+    def test_batches_only_batch_hooks(self, psycopg2_connect):
+        intermix.register_hook(TestRegistry.LoadHook)
+        try:
+            TestRegistry.LoadHook().run(['select 1;', 'select 2;'])
+        finally:
+            intermix.disable_annotation(TestRegistry.LoadHook)
+        self.assertEqual(2, psycopg2_connect.return_value.cursor.return_value.execute.call_count)
+
+    def test_passes_other_arguments_through(self):
+        original = MagicMock()
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        statements = ['select 1;', 'select 2;']
+        intermix._run_batched(original, hook, statements, True, handler=len)
+        original.assert_called_once_with(hook, statements, True, handler=len)
+
+    def test_payload_limit(self):
+        payloads = list(intermix._batches(['select 10;', 'select 20', 'select 30;', 'select 40;'], limit=24))
+        self.assertEqual([('select 10;\nselect 20\n;', 0, 2), ('select 30;\nselect 40;', 2, 4)], payloads)
+        self.assertEqual([(0, 1), (1, 2)], [(start, end) for payload, start, end in
+                                            intermix._batches(['select 1;' * 3, 'select 2;'], limit=20)])
+
+    def test_terminates_statements(self):
+        for statement in ('select 1;', 'select 1; -- done', "select ';' /* ; */;\n"):
+            self.assertEqual(statement, intermix._terminated(statement))
+        for statement in ('select 1 -- done;', 'select 1 /* ; */', "select ';'", 'select $$;$$'):
+            self.assertEqual(statement + '\n;', intermix._terminated(statement))
+
+    @patch.object(psycopg2, 'connect')
+    def test_reports_failing_statement(self, psycopg2_connect):
+        def execute(sql, parameters=None):
+            if 'from missing' in sql:
+                raise psycopg2.ProgrammingError(sql[-30:])
+        cursor = psycopg2_connect.return_value.cursor.return_value
+        cursor.execute.side_effect = execute
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+
+        with self.assertRaises(psycopg2.ProgrammingError) as raised:
+            hook.run(['delete from events;', 'insert into events select * from missing;', 'select 1;'])
+        self.assertEqual('insert into events select * from missing;'[-30:], str(raised.exception))
+        psycopg2_connect.return_value.rollback.assert_called_once_with()
+        self.assertFalse(psycopg2_connect.return_value.commit.called)
+        # The payload, then the statements up to the failing one
+        self.assertEqual(3, cursor.execute.call_count)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+    def factory(self, hook):
+        connection = MagicMock()
+        self.connections.append(connection)
+        return connection
+
+    def test_reuses_connection_within_task(self):
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        with intermix.pooled_connections(self.factory):
+            hook.run(sql=['select 1;', 'select 2;'])
+            hook.get_records(sql='select 3;')
+            hook.get_first(sql='select 4;')
+            self.assertEqual(1, len(self.connections))
+            self.assertFalse(self.connections[0].close.called)
+
+        # The connection is closed at the end of the task
+        self.connections[0].close.assert_called_once_with()
+        self.assertEqual(4, self.connections[0].cursor.return_value.execute.call_count)
+
+    def test_resets_autocommit(self):
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        with intermix.pooled_connections(self.factory):
+            hook.run(sql='select 1;', autocommit=True)
+            self.assertIs(False, self.connections[0].autocommit)
+            connection = hook.get_conn()
+            self.assertIs(False, connection.autocommit)
+            connection.close()
+            self.assertEqual(1, len(self.connections))
+
+        # A connection that can't be reset is closed rather than pooled
+        pool = intermix.ConnectionPool(self.factory)
+        connection = pool.acquire('postgres_default', None)
+        type(self.connections[1]).autocommit = PropertyMock(side_effect=psycopg2.ProgrammingError)
+        connection.close()
+        self.connections[1].close.assert_called_once_with()
+        pool.acquire('postgres_default', None)
+        self.assertEqual(3, len(self.connections))
+
+    def test_keys_connections_by_database(self):
+        with intermix.pooled_connections(self.factory):
+            PostgresHook(postgres_conn_id='postgres_default', schema='events').get_records(sql='select 1;')
+            PostgresHook(postgres_conn_id='postgres_default', schema='users').get_records(sql='select 1;')
+            PostgresHook(postgres_conn_id='postgres_default', schema='events').get_records(sql='select 1;')
+            self.assertEqual(2, len(self.connections))
+
+    def test_bounded_idle_connections(self):
+        pool = intermix.ConnectionPool(self.factory, max_idle=1)
+        first = pool.acquire('postgres_default', None)
+        second = pool.acquire('postgres_default', None)
+        first.close()
+        second.close()
+        self.assertEqual(2, len(self.connections))
+        self.assertFalse(self.connections[0].close.called)
+        self.connections[1].close.assert_called_once_with()
+
+        # Connections are keyed by connection id
+        pool.acquire('redshift_default', None).close()
+        self.assertEqual(3, len(self.connections))
+        pool.close()
+        self.connections[0].close.assert_called_once_with()
+        self.connections[2].close.assert_called_once_with()
+
+    def test_evicts_idle_connections(self):
+        pool = intermix.ConnectionPool(self.factory, idle_timeout=0)
+        pool.acquire('postgres_default', None).close()
+        pool.acquire('postgres_default', None).close()
+        self.assertEqual(2, len(self.connections))
+        self.connections[0].close.assert_called_once_with()
+        pool.close()
+        self.connections[1].close.assert_called_once_with()
+
+
+class TestSamplingPolicy(unittest.TestCase):
+
+    def tearDown(self):
+        intermix._sampling_policies.clear()
+
+    @patch.object(psycopg2, 'connect')
+    def test_samples_hook_annotations(self, psycopg2_connect):
+        execute = psycopg2_connect.return_value.cursor.return_value.execute
+        intermix.set_sampling_policy(intermix.SamplingPolicy(first=2, every=3))
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        for _ in range(10):
+            hook.get_first('select 1;')
+
+        annotated = [intermix.decode_annotation(args[0]) != {} for args, kwargs in execute.call_args_list]
+        self.assertEqual([True, True, True, False, False, True, False, False, True, False], annotated)
+        self.assertEqual(intermix.SAMPLED_ANNOTATION + 'select 1;', execute.call_args_list[3][0][0])
+
+    @patch.object(psycopg2, 'connect')
+    def test_samples_sensor_pokes_by_dag(self, psycopg2_connect):
+        execute = psycopg2_connect.return_value.cursor.return_value.execute
+        fetchone = psycopg2_connect.return_value.cursor.return_value.fetchone
+        fetchone.side_effect = [(0,)] * 4 + [(1,)]
+
+        class EventsSensor(BaseSensorOperator):
+            def poke(self, context):
+                return PostgresHook(postgres_conn_id='postgres_default').get_first('select count(*) from events;')[0]
+
+        sensor = EventsSensor(task_id='wait_for_events', poke_interval=0)
+        intermix.set_sampling_policy(intermix.SamplingPolicy(first=2, every=1000), dag_id=sensor.dag_id)
+        sensor.execute(None)
+
+        # The pokes are attributed to the sensor, so the DAG policy applies rather than annotating every poke
+        blobs = [intermix.decode_annotation(args[0]) for args, kwargs in execute.call_args_list]
+        self.assertEqual([True, True, True, False, False], [blob != {} for blob in blobs])
+        self.assertEqual(('wait_for_events', 'poke'), (blobs[0]['task'], blobs[0]['function']))
+
+    def test_most_specific_policy_applies(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'poke', '12')
+        PO = PostgresOperator(sql='select 1;', task_id='some_task')
+        intermix.set_sampling_policy(intermix.SamplingPolicy(first=0, every=1000), dag_id=PO.dag_id)
+        intermix.set_sampling_policy(intermix.SamplingPolicy(first=0, interval=3600), call_site=('dags/etl.py', 12))
+        with patch.object(time, 'time', return_value=1000.0):
+            self.assertEqual([True, False, False],
+                             [intermix.sample_annotation(inspected, PO) for _ in range(3)])
+        with patch.object(time, 'time', return_value=4600.0):
+            self.assertTrue(intermix.sample_annotation(inspected, PO))
+
+        # Other call sites of the DAG fall back to the DAG policy
+        other = ('dags/etl.py', 'etl', 'Loader', 'poke', '20')
+        self.assertEqual([True, False], [intermix.sample_annotation(other, PO) for _ in range(2)])
+        self.assertTrue(intermix.sample_annotation(other))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        intermix.set_metrics_sink(None)
+
+    @patch.object(psycopg2, 'connect')
+    def test_measures_hook_calls(self, psycopg2_connect):
+        cursor = psycopg2_connect.return_value.cursor.return_value
+        cursor.fetchall.return_value = [(1,), (2,), (3,)]
+        cursor.fetchone.return_value = None
+        sink = intermix.HistogramMetricsSink()
+        intermix.set_metrics_sink(sink)
+
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        line = sys._getframe().f_lineno
+        hook.get_records('select * from events;')
+        hook.get_first('select * from events;')
+        hook.run('truncate events;')
+
+        call_site = {'file': sys._getframe().f_code.co_filename, 'function': 'test_measures_hook_calls'}
+        records = sink.get('query.rows', method='get_records', linenumber=str(line + 1), **call_site)
+        self.assertEqual((1, 3), (records.count, records.total))
+        first = sink.get('query.rows', method='get_first', linenumber=str(line + 2), **call_site)
+        self.assertEqual((1, 0), (first.count, first.total))
+        self.assertIsNone(sink.get('query.rows', method='run', linenumber=str(line + 3), **call_site))
+        for offset, method in enumerate(('get_records', 'get_first', 'run'), 1):
+            for metric in ('annotation.duration', 'query.duration'):
+                self.assertEqual(1, sink.get(metric, method=method, linenumber=str(line + offset), **call_site).count)
+
+    @patch.object(psycopg2, 'connect')
+    def test_measures_operator(self, psycopg2_connect):
+        sink = intermix.HistogramMetricsSink()
+        intermix.set_metrics_sink(sink)
+        PO = PostgresOperator(sql='select * from users;', task_id='some_task')
+        line = sys._getframe().f_lineno
+        PO.execute(None)
+        tags = [dict(tags) for metric, tags in sink.histograms if metric == 'query.duration']
+        self.assertIn({'method': 'execute', 'dag': 'adhoc_Airflow', 'task': 'some_task',
+                       'file': sys._getframe().f_code.co_filename, 'function': 'test_measures_operator',
+                       'linenumber': str(line + 1)}, tags)
+
+        # The hook call made by the operator is measured too, and attributed to the operator
+        self.assertIn(('run', 'some_task'), [(tag['method'], tag['task']) for tag in tags])
+
+    def test_statsd_payload(self):
+        with patch.object(socket, 'socket') as statsd_socket:
+            sink = intermix.StatsdMetricsSink('statsd.local', 8125)
+            sink.timing('query.duration', 12.5, {'task': 'load', 'function': 'run|all'})
+            sink.histogram('query.rows', 3, {})
+        self.assertEqual([((b'intermix.query.duration:12.5|ms|#function:run_all,task:load', ('statsd.local', 8125)),),
+                          ((b'intermix.query.rows:3|h', ('statsd.local', 8125)),)],
+                         [call[0:1] for call in statsd_socket.return_value.sendto.call_args_list])
+
+    def test_histogram(self):
+        histogram = intermix.Histogram()
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertEqual((100, 5050, 1, 100), (histogram.count, histogram.total, histogram.min, histogram.max))
+        self.assertEqual(50, histogram.percentile(50))
+        self.assertEqual(100, histogram.percentile(99))
+
+
+class TestQueryJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.db')
+
+    def tearDown(self):
+        intermix.set_journal(None)
+        shutil.rmtree(self.directory)
+
+    @patch.object(psycopg2, 'connect')
+    def test_records_annotated_statements(self, psycopg2_connect):
+        journal = intermix.SqliteQueryJournal(self.path)
+        intermix.set_journal(journal)
+
+        PostgresOperator(sql='select * from users;', task_id='some_task').execute(None)
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        hook.run(['truncate events;', 'select 1;', intermix.annotator(intermix.inspector()) + 'select 2;'])
+        journal.close()
+
+        entries = list(intermix.read_journal(self.path))
+        expected = [('execute', 0, 'some_task', 'select * from users;'), ('run', 0, '', 'truncate events;'),
+                    ('run', 1, '', 'select 1;')]
+        self.assertEqual([(method, index, task, intermix.fingerprint(sql))
+                          for method, index, task, sql in expected],
+                         [(entry['method'], entry['statement_index'], entry.get('task', ''), entry['fingerprint'])
+                          for entry in entries])
+        cursor = psycopg2_connect.return_value.cursor.return_value
+        statements = [args[0] for args, kwargs in cursor.execute.call_args_list]
+        self.assertEqual(statements[0].split('*/')[0] + '*/', entries[0]['annotation'])
+        self.assertEqual('test_records_annotated_statements', entries[1]['function'])
+        self.assertEqual(0, entries[1]['failed'])
+        self.assertNotEqual(entries[1]['fingerprint'], entries[2]['fingerprint'])
+
+    def test_exports_journal(self):
+        journal = intermix.SqliteQueryJournal(self.path)
+        inspected = ('dags/load.py', 'load', '', 'load_events', '12')
+        journal.record('run', [intermix.annotator(inspected) + 'select 1;'], 1514764800000, 0.1, 12.5, False)
+        journal.close()
+
+        output = os.path.join(self.directory, 'journal.json')
+        self.assertEqual(0, intermix.main([self.path, '--format', 'json', '--output', output]))
+        with open(output) as exported:
+            entry = json.loads(exported.read())
+        self.assertEqual(('2018-01-01T00:00:00Z', 12.5, 'load_events'),
+                         (entry['started_at'], entry['duration_ms'], entry['function']))
+        self.assertEqual([], list(intermix.read_journal(self.path, since=datetime(2018, 1, 2))))
+
+    def test_queues_statement_heads(self):
+        journal = intermix.SqliteQueryJournal(self.path)
+        inspected = ('dags/load.py', 'load', '', 'load_events', '12')
+        # The last character that is fingerprinted tells the statements apart
+        limit = intermix.FINGERPRINT_LIMIT
+        statement = 'select {}a from events;'.format('c' * (limit - 8))
+        other = 'select {}b from events;'.format('c' * (limit - 8))
+        self.assertNotEqual(intermix.fingerprint(statement), intermix.fingerprint(other))
+        with patch.object(journal, '_queue') as queue:
+            journal.record('run', ['select 1;', intermix.annotator(inspected) + statement], 1514764800000, 0.1, 12.5,
+                           False)
+            with patch.object(intermix, 'FINGERPRINT_STATEMENTS', True):
+                journal.record('run', [intermix.annotator(inspected, statement=other) + other], 1514764800000, 0.1,
+                               12.5, False)
+        journal.close()
+
+        entries = [args[0][0] for args in queue.put_nowait.call_args_list]
+        self.assertEqual([(1, statement[:limit])], [(index, head) for index, annotation, head in entries[0][1]])
+        self.assertEqual([intermix.fingerprint(statement), intermix.fingerprint(other)],
+                         [list(journal._rows(entry))[0][6] for entry in entries])
+
+
+class TestSlowCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        intermix.set_slow_call_recorder(None)
+        shutil.rmtree(self.directory)
+
+    def records(self):
+        records = []
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name)) as record_file:
+                records.append(json.load(record_file))
+        return records
+
+    @patch.object(psycopg2, 'connect')
+    def test_records_slow_calls(self, psycopg2_connect):
+        def connect(*args, **kwargs):
+            time.sleep(0.05)
+            return connection
+        connection = psycopg2_connect.return_value
+        psycopg2_connect.side_effect = connect
+        connection.cursor.return_value.execute.side_effect = lambda sql, parameters=None: time.sleep(0.1)
+        intermix.set_slow_call_recorder(intermix.DirectorySlowCallRecorder(self.directory, 0.12, profile=True,
+                                                                           interval=0.005))
+
+        PostgresHook(postgres_conn_id='postgres_default').run('select 1;')
+        PostgresHook(postgres_conn_id='postgres_default').get_first('select 1;')
+        connection.cursor.return_value.execute.side_effect = None
+        PostgresHook(postgres_conn_id='postgres_default').get_records('select 1;')
+
+        records = self.records()
+        self.assertEqual(['get_first', 'run'], sorted(record['method'] for record in records))
+        record = records[0]
+        self.assertEqual('test_records_slow_calls', record['call_site']['function'])
+        self.assertGreaterEqual(record['connect_ms'], 50)
+        self.assertGreaterEqual(record['execution_ms'], 100)
+        self.assertAlmostEqual(record['duration_ms'], record['connect_ms'] + record['execution_ms'])
+        self.assertGreater(record['profile']['samples'], 0)
+        self.assertTrue(any('test_records_slow_calls' in frame for stack in record['profile']['stacks']
+                            for frame in stack['stack']))
+
+
+def load_plugin_copy(name):
+    """ Loads intermix.py under another module name, the way Airflow's plugin manager does """
+
+    path = os.path.join(os.path.dirname(os.path.realpath(intermix.__file__)), 'intermix.py')
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = sys.modules[name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestImportHook(unittest.TestCase):
+
+    def test_patches_on_import(self):
+        code = ('import sys; import intermix; assert "airflow" not in sys.modules; '
+                'from airflow.hooks.postgres_hook import PostgresHook; print(PostgresHook.run.__name__)')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.realpath(intermix.__file__)))
+        self.assertEqual(b'pg_run', output.strip())
+
+    @patch.object(psycopg2, 'connect')
+    def test_plugin_copy_settings(self, psycopg2_connect):
+        """ Test the settings made through a copy of the plugin loaded after intermix apply to the patched classes
+        """
+        plugin = load_plugin_copy('plugins_intermix')
+        self.addCleanup(sys.modules.pop, 'plugins_intermix', None)
+        self.assertIs(intermix, sys.modules['plugins_intermix'])
+        self.assertEqual(1, len([finder for finder in sys.meta_path
+                                 if getattr(finder, 'intermix_patching_finder', False)]))
+
+        execute = psycopg2_connect.return_value.cursor.return_value.execute
+        hook = PostgresHook(postgres_conn_id='postgres_default')
+        plugin.set_sampling_policy(plugin.SamplingPolicy(first=0, every=None))
+        self.addCleanup(intermix._sampling_policies.clear)
+        sink = plugin.HistogramMetricsSink()
+        plugin.set_metrics_sink(sink)
+        self.addCleanup(intermix.set_metrics_sink, None)
+        hook.get_first('select 1;')
+        self.assertEqual(intermix.SAMPLED_ANNOTATION + 'select 1;', execute.call_args[0][0])
+        self.assertIn('query.duration', [metric for metric, tags in sink.histograms])
+
+        journal = intermix.QueryJournal()
+        plugin.set_journal(journal)
+        self.addCleanup(intermix.set_journal, None)
+        recorder = intermix.SlowCallRecorder()
+        plugin.set_slow_call_recorder(recorder)
+        self.addCleanup(intermix.set_slow_call_recorder, None)
+        self.assertEqual((journal, recorder), (intermix._journal, intermix._slow_call_recorder))
+
+        connections = []
+        with plugin.pooled_connections(lambda hook: connections.append(MagicMock()) or connections[-1]):
+            hook.get_records('select 1;')
+            hook.get_records('select 2;')
+        self.assertEqual(1, len(connections))
+
+    def test_plugin_copy_is_intermix(self):
+        """ Test the API of intermix applies when Airflow's plugin manager loaded the plugin first, under another name
+        """
+        code = '\n'.join([
+            'import sys',
+            'try:',
+            '    from imp import load_source',
+            'except ImportError:',
+            '    import importlib.util',
+            '    def load_source(name, path):',
+            '        spec = importlib.util.spec_from_file_location(name, path)',
+            '        module = sys.modules[name] = importlib.util.module_from_spec(spec)',
+            '        spec.loader.exec_module(module)',
+            '        return module',
+            'plugin = load_source("plugins_intermix", "intermix.py")',
+            'import intermix',
+            'intermix.register_hook("airflow.hooks.dbapi_hook.DbApiHook")',
+            'intermix.disable_annotation("airflow.hooks.postgres_hook.PostgresHook")',
+            'from airflow.hooks.dbapi_hook import DbApiHook',
+            'from airflow.hooks.postgres_hook import PostgresHook',
+            'finders = [finder for finder in sys.meta_path if getattr(finder, "intermix_patching_finder", False)]',
+            'print(intermix is plugin, len(finders), DbApiHook.run.__name__, "get_first" in vars(PostgresHook))'])
+        output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code],
+                                         cwd=os.path.dirname(os.path.realpath(intermix.__file__)))
+        self.assertEqual(b'True 1 intermix_run False', output.strip())
+
+
+class TestScriptSplitting(unittest.TestCase):
+
+    def test_splits_statements(self):
+        self.assertEqual(['select 1;', ' select 2;', '\nselect 3\n'],
+                         intermix.split_statements('select 1; select 2;\nselect 3\n'))
+        # Empty statements, whitespace and comments stay with a neighbouring statement
+        self.assertEqual([';; select 1; -- done;\n/* ; */ '],
+                         intermix.split_statements(';; select 1; -- done;\n/* ; */ '))
+        self.assertEqual(['/* a; */ select 1;', ' select 2;'],
+                         intermix.split_statements('/* a; */ select 1; select 2;'))
+        self.assertEqual(['   '], intermix.split_statements('   '))
+
+    def test_ignores_quoted_semicolons(self):
+        scripts = [
+            ["select 'a;''b';", " select 1;"],
+            ['select "a;""b" from t;', ' select 1;'],
+            ["select E'a\\';b';", " select 1;"],
+            ["select 'a\\\\';", " select ';';"],
+            ["insert into t values ('it\\'s; ok');", " select 1;"],
+            ['select 1 /* a /* ; */ ; */;', ' select 1;'],
+            ['select 1 -- ;\n;', ' select 1;'],
+            ['create function f() returns int as $$ select 1; $$ language sql;', ' select 1;'],
+            ['select $body$ $$; $body$;', ' select 1;'],
+            ['select a$b$c;', ' select $b$;'],
+        ]
+        for statements in scripts:
+            self.assertEqual(statements, intermix.split_statements(''.join(statements)))
+
+    def test_unterminated_tokens(self):
+        for script in ["select 'a;", 'select "a;', 'select /* ;', 'select $$ ;', "select 1; select 'a;"]:
+            self.assertEqual(script, ''.join(intermix.split_statements(script)))
+
+
+class TestAnnotator(unittest.TestCase):
+
+    def decode(self, annotation):
+        return json.loads(base64.b64decode(annotation[16:-4]))
+
+    def test_matches_full_serialization(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'load', '12')
+        PO = PostgresOperator(sql='select 1;', task_id='some_task', pool='redshift')
+        for _self in (None, PO):
+            expected = intermix._blob(inspected, _self)
+            blob = self.decode(intermix.annotator(inspected, _self))
+            self.assertLessEqual(expected.pop('at'), blob.pop('at'))
+            self.assertDictEqual(expected, blob)
+
+    def test_call_site_fields_are_cached(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'load', '12')
+        intermix._call_site_fragments.clear()
+        with patch.object(intermix, '_serialize', wraps=intermix._serialize) as serialize:
+            blobs = [self.decode(intermix.annotator(inspected)) for _ in range(3)]
+        self.assertEqual(1, len([args for args, kwargs in serialize.call_args_list if 'function' in args[0]]))
+        for blob in blobs:
+            self.assertEqual(('load', '12'), (blob['function'], blob['linenumber']))
+            self.assertIn('at', blob)
+
+        with patch.object(intermix, 'CALL_SITE_CACHE_SIZE', 2):
+            for line in range(3):
+                intermix.annotator(inspected[:4] + (str(line),))
+            self.assertLessEqual(len(intermix._call_site_fragments), 2)
+
+    def test_operator_head_is_cached(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'load', '12')
+        PO = PostgresOperator(sql='select 1;', task_id='some_task')
+        intermix.annotator(inspected, PO)
+        head = PO._intermix_head
+        intermix.annotator(inspected, PO)
+        self.assertIs(head, PO._intermix_head)
+
+        # Changing an operator field invalidates the cached head
+        PO.pool = 'redshift'
+        self.assertEqual('redshift', self.decode(intermix.annotator(inspected, PO))['pool'])
+        self.assertIsNot(head, PO._intermix_head)
+
+    def test_compact_encoding(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'load', '12')
+        PO = PostgresOperator(sql='select 1;', task_id='some_task')
+        v1 = intermix.annotator(inspected, PO)
+        with patch.object(intermix, 'ANNOTATION_VERSION', 2):
+            v2 = intermix.annotator(inspected, PO)
+            batch = intermix.batch_annotator(inspected, 3, PO)
+        self.assertEqual('/* INTERMIX_ID: v2.', v2[:19])
+        self.assertLess(len(v2), len(v1))
+
+        # Both versions decode to the same blob
+        v1_blob = intermix.decode_annotation(v1)
+        v2_blob = intermix.decode_annotation(v2)
+        self.assertLessEqual(abs(datetime.strptime(v1_blob.pop('at'), "%Y-%m-%dT%H:%M:%S.%fZ") -
+                                 datetime.strptime(v2_blob.pop('at'), "%Y-%m-%dT%H:%M:%S.%fZ")).total_seconds(), 1)
+        self.assertDictEqual(v1_blob, v2_blob)
+        self.assertEqual([0, 1, 2], [intermix.decode_annotation(blob)['statement_index'] for blob in batch])
+
+    def test_unknown_version_falls_back(self):
+        for value, version in (('2', 2), ('3', 1), ('v2', 1)):
+            with patch.dict(os.environ, {'INTERMIX_ANNOTATION_VERSION': value}):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    self.assertEqual(version, intermix._env_annotation_version())
+            self.assertEqual(version != 2, len(caught) == 1)
+
+    def test_compact_encoding_keeps_prior_annotation(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'load', '12')
+        prior = intermix.annotator(('dags/old.py', 'old', '', 'run', '3')) + 'select 1;'
+        with patch.object(intermix, 'ANNOTATION_VERSION', 2):
+            v2 = intermix.annotator(inspected, prior_annotation=intermix.INTERMIX_RE.match(prior))
+        prior_blob = intermix.decode_annotation(prior)
+        v2_blob = intermix.decode_annotation(v2)
+        self.assertEqual(prior_blob.pop('at')[:23], v2_blob.pop('at')[:23])
+        self.assertDictEqual(prior_blob, v2_blob)
+        self.assertIsNone(intermix.decode_annotation('select 1;'))
+
+    def test_fingerprint(self):
+        fingerprint = intermix.fingerprint("select * from t_1 where a = 'it''s' and b > 1.5 -- today\n")
+        self.assertEqual(fingerprint, intermix.fingerprint("select * from t_1 where a = 'x' and b > 20 -- tomorrow"))
+        self.assertEqual(fingerprint, intermix.fingerprint("select * from t_1 where a = $q$x$q$ and b > 1e3 /* c */"))
+        self.assertNotEqual(fingerprint, intermix.fingerprint("select * from t_2 where a = 'x' and b > 20"))
+
+        # Only the head of long statements is normalized, and the fingerprints of short ones are memoized
+        with patch.object(intermix, 'FINGERPRINT_LIMIT', 20):
+            self.assertEqual(intermix.fingerprint('select 1 from t_1 where a = 1'),
+                             intermix.fingerprint('select 1 from t_1 where b = 2'))
+        statement = 'select * from t_3 where a = 1'
+        with patch.object(intermix, '_LITERAL_RE') as literal_re:
+            literal_re.sub.return_value = 'select * from t_3 where a = ?'
+            self.assertEqual(intermix.fingerprint(statement), intermix.fingerprint(statement))
+        self.assertEqual(1, literal_re.sub.call_count)
+
+    def test_fingerprint_annotations(self):
+        inspected = ('dags/etl.py', 'etl', 'Loader', 'load', '12')
+        statements = ["select * from events where day = '2018-01-01';", 'truncate events;']
+        blob = intermix.decode_annotation(intermix.annotator(inspected, statement='select 1;'))
+        self.assertNotIn('fingerprint', blob)
+        with patch.object(intermix, 'FINGERPRINT_STATEMENTS', True):
+            for version in (1, 2):
+                with patch.object(intermix, 'ANNOTATION_VERSION', version):
+                    blob = intermix.decode_annotation(intermix.annotator(inspected, statement=statements[0]))
+                    batch = intermix.batch_annotator(inspected, 2, statements=statements)
+                self.assertEqual(intermix.fingerprint(statements[0]), blob['fingerprint'])
+                self.assertEqual([(0, intermix.fingerprint(statements[0])), (1, intermix.fingerprint(statements[1]))],
+                                 [(intermix.decode_annotation(annotation)['statement_index'],
+                                   intermix.decode_annotation(annotation)['fingerprint']) for annotation in batch])
+
+
+class TestSizeBudget(unittest.TestCase):
+
+    def test_utf8_length(self):
+        for text in ('select 1;', "select '\u00e9t\u00e9';", "select '\u6f22\u5b57', '\U0001f600';", ''):
+            self.assertEqual(len(text.encode('utf-8')), intermix.utf8_length(text))
+        with patch.object(intermix, '_UTF8_CHUNK', 4):
+            self.assertEqual(24, intermix.utf8_length('\u6f22' * 100 + 'a', 20))
+            self.assertEqual(301, intermix.utf8_length('\u6f22' * 100 + 'a'))
+
+    def test_degrades_annotation(self):
+        inspected = ('/usr/local/airflow/dags/warehouse/load_events.py', 'load', 'Loader', 'load_partition', '214')
+        full, without_file, minimal = [intermix.annotator(inspected, drop=drop)
+                                       for drop in intermix.ANNOTATION_DEGRADATIONS]
+        self.assertEqual(('', 'Loader', 'load_partition'),
+                         tuple(intermix.decode_annotation(without_file).get(key, '')
+                               for key in ('file', 'classname', 'function')))
+        self.assertEqual(('', '', '', 'load', '214'),
+                         tuple(intermix.decode_annotation(minimal).get(key, '')
+                               for key in ('file', 'classname', 'function', 'module', 'linenumber')))
+
+        # Two byte characters, which only fit with a smaller annotation, or none at all
+        limit = len(full) + 200
+        statements = [''.join(['select ', '\u00e9' * ((limit - len(blob)) // 2 - 4), ';'])
+                      for blob in (full, without_file, minimal)]
+        statements.append(statements[-1] + '\u00e9')
+        sent = []
+        with patch.object(intermix, '_size_budget', intermix.SizeBudget(limit)):
+            with patch.object(intermix, 'inspector', return_value=inspected):
+                for statement in statements:
+                    sent.append(intermix._annotate_statements(statement, intermix.inspector()))
+        annotations = [statement[:statement.index('*/ ') + 3] for statement in sent[:3]]
+        self.assertEqual([len(full), len(without_file), len(minimal)], [len(annotation) for annotation in annotations])
+        self.assertEqual([True, False, False], ['file' in intermix.decode_annotation(annotation)
+                                                for annotation in annotations])
+        self.assertTrue(all(len(statement.encode('utf-8')) <= limit for statement in sent))
+        self.assertEqual(statements[3], sent[3])
+
+
+class TestInspector(unittest.TestCase):
+
+    def annotated_call(self):
+        return intermix.inspector()
+
+    def test_call_site_is_cached(self):
+        intermix._call_site_cache.clear()
+        first = self.annotated_call()
+        second = self.annotated_call()
+        self.assertEqual(('__main__', 'TestInspector', 'test_call_site_is_cached'), first[1:4])
+        self.assertEqual(first[:4], second[:4])
+        self.assertEqual(2, len(intermix._call_site_cache))
+
+        # The same call site only resolves once
+        resolved = [self.annotated_call() for _ in range(10)]
+        for call_site in resolved:
+            self.assertIs(resolved[0], call_site)
+        self.assertEqual(3, len(intermix._call_site_cache))
+
+    def test_call_site_cache_is_bounded(self):
+        intermix._call_site_cache.clear()
+        with patch.object(intermix, 'CALL_SITE_CACHE_SIZE', 2):
+            self.annotated_call()
+            self.annotated_call()
+            self.annotated_call()
+        self.assertEqual(2, len(intermix._call_site_cache))
+
 
 if __name__ == '__main__':
     unittest.main()